@@ -65,6 +65,10 @@ class Datum(Declare):
     tsrc = Column(Integer)
     parameter_id = Column(Integer, ForeignKey('parameters.id'))
     dataBZ2 = Column(BLOB)
+    # read a correlator in configuration order without sorting;
+    # upgrade_db.py adds it to existing databases
+    __table_args__ = (Index('ix_data_correlator_config',
+                            'correlator_id','series','trajectory','tsrc','id'),)
     def __init__(self,correlator,series,trajectory,tsrc,params,sdata,doTranslate):
         self.correlator_id = correlator.id
         self.series = series
@@ -92,7 +96,7 @@ class Datum(Declare):
 class Correlator(Declare):
     __tablename__ = 'correlators'
     id = Column(Integer, Sequence('correlator_id_seq'), primary_key=True)
-    name = Column(String)
+    name = Column(String, index=True)
     parameter_id = Column(Integer, ForeignKey('parameters.id'))
     parameters = relationship(ParameterSet,primaryjoin=parameter_id==ParameterSet.id)
     data = relationship(Datum,primaryjoin=id==Datum.correlator_id)
@@ -103,6 +107,19 @@ class Correlator(Declare):
         return
     pass
 
+def file_md5(path, chunk_size=1<<20):
+    "md5 hex digest of a file, read in chunks of chunk_size bytes"
+    digest = hashlib.md5()
+    fio = open(path,'rb')
+    try:
+        for chunk in iter(lambda: fio.read(chunk_size), ''):
+            digest.update(chunk)
+            pass
+    finally:
+        fio.close()
+        pass
+    return digest.hexdigest()
+
 # additional table to support incremental DB builds
 class InputFile(Declare):
     __tablename__ = 'correlator_files'
@@ -120,6 +137,6 @@ class InputFile(Declare):
         self.addtime = datetime.datetime.utcnow()
         self.md5 = md5
         if md5 is None:
-            self.md5 = hashlib.md5(open(path,'rb').read()).hexdigest()
+            self.md5 = file_md5(path)
         return
     pass
@@ -0,0 +1,320 @@
+"""
+Benchmark the gather pipeline on synthetic databases.
+
+A synthetic database uses the schema of DB.py (ParameterSet, Correlator and
+Datum with bz2 encoded data) and is sized like one of the ensembles in the
+README. Duplicate entries, non-identical duplicate entries and missing time
+sources can be added at a configurable rate. Every stage of the pipeline is
+timed and the results are written as a json report, which can be compared
+against the report of an earlier version to catch regressions. The import
+stages and gather_warm_process run in fresh interpreters, so they include
+the time to import the modules that a cache hit needs.
+
+usage: python benchmark.py --ensemble l4864f211b600m001907m05252m6382 \
+           --ntraj 500 --output report.json [--compare old_report.json]
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import socket
+import subprocess
+import argparse
+import tempfile
+import datetime
+import bz2
+import numpy as np
+import sqlalchemy
+from DB import *
+from blob_codec import *
+from corr_db import *
+from gather_data import *
+from gather_data import _generate_correlator_keys_baryon
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Time extent and light quark mass of the ensembles in the README
+ENSEMBLES = {
+    'l3248f211b580m002426m06730m8447': {'nt': 48, 'mass': 0.002426},
+    'l4864f211b600m001907m05252m6382': {'nt': 64, 'mass': 0.001907},
+    'l6496f211b630m0012m0363m432':     {'nt': 96, 'mass': 0.0012},
+}
+
+def make_database(db_name, ensemble, ntraj, tsrc_list, class_list, series_list=('a',),
+                  traj_step=5, dup_rate=0., bad_dup_rate=0., missing_rate=0., seed=1,
+                  codec=LEGACY_CODEC):
+    """
+    Create a synthetic database `db_name` for `ensemble` with the 16p and 16m
+    correlators of all source/sink classes in `class_list`. Every series has
+    `ntraj` trajectories with the time sources in `tsrc_list`. A fraction
+    `dup_rate` of the entries is stored twice, a fraction `bad_dup_rate` is
+    stored a second time with different data and a fraction `missing_rate`
+    is left out. The data are encoded with `codec` (see blob_codec). Return
+    the number of data entries.
+    """
+    if os.path.isfile(db_name):
+        os.remove(db_name)
+    nt = ENSEMBLES[ensemble]['nt']
+    mass = ENSEMBLES[ensemble]['mass']
+    rng = np.random.RandomState(seed)
+    # The same entries are missing or duplicated for every correlator, as
+    # they would be for correlators computed in the same production run
+    layout = []
+    for series in series_list:
+        for itraj in range(ntraj):
+            for tsrc in tsrc_list:
+                if rng.rand() < missing_rate:
+                    continue
+                layout.append((series, traj_step*itraj, tsrc,
+                               rng.rand() < dup_rate, rng.rand() < bad_dup_rate))
+    engine = create_engine('sqlite:///'+db_name)
+    Declare.metadata.create_all(engine)
+    conn = engine.connect()
+    nrows = 0
+    try:
+        param_id = conn.execute(ParameterSet.__table__.insert(),
+                                param=json.dumps({'ensemble': ensemble}),
+                                ).inserted_primary_key[0]
+        conn.execute(DBtimestamp.__table__.insert(), time=datetime.datetime.utcnow())
+        for irrep in ['16p', '16m']:
+            for src_class in class_list:
+                for sink_class in class_list:
+                    name = "nd_b_%s_s_%s_%s_s_%s_cw0_cw0_cw0_d_d_d_m%s_m%s_m%s" %(
+                        irrep, src_class, irrep, sink_class, str(mass), str(mass), str(mass))
+                    corr_id = conn.execute(Correlator.__table__.insert(), name=name,
+                                           parameter_id=param_id).inserted_primary_key[0]
+                    rows = []
+                    for series, trajectory, tsrc, dup, bad_dup in layout:
+                        data = np.exp(-0.5*np.arange(nt))*(1. + 0.05*rng.randn(nt))
+                        row = {'correlator_id': corr_id, 'series': series,
+                               'trajectory': trajectory, 'tsrc': tsrc,
+                               'parameter_id': param_id,
+                               'dataBZ2': _encode(data, codec)}
+                        rows.append(row)
+                        if dup:
+                            rows.append(dict(row))
+                        if bad_dup:
+                            rows.append(dict(row, dataBZ2=_encode(1.1*data, codec)))
+                    trans = conn.begin()
+                    conn.execute(Datum.__table__.insert(), rows)
+                    trans.commit()
+                    nrows += len(rows)
+    finally:
+        conn.close()
+        engine.dispose()
+    return nrows
+
+def _encode(data, codec):
+    """
+    Encode one entry, with the text format of the correlator files for the
+    legacy codec.
+    """
+    if codec == LEGACY_CODEC:
+        return bz2.compress('\n'.join(['%.15e'%x for x in data]), 9)
+    return encode_blob(data, codec=codec)
+
+class _Quiet():
+    """
+    Context manager that silences the progress output of the pipeline.
+    """
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def _time(func, repeat):
+    """
+    Run func `repeat` times. Return the list of wall times and the last result.
+    """
+    times = []
+    for irepeat in range(repeat):
+        start_time = time.time()
+        with _Quiet():
+            result = func()
+        times.append(time.time() - start_time)
+    return times, result
+
+def _time_process(statements, repeat):
+    """
+    Run `statements` `repeat` times in a fresh interpreter, where no module
+    of the package is imported yet, and time them there. Return the list of
+    wall times and whether SQLAlchemy was imported in the last run.
+    """
+    script = '\n'.join(['import sys, time, json',
+                        'sys.path.insert(0, %r)' %PACKAGE_DIR,
+                        'start_time = time.time()',
+                        statements,
+                        'print json.dumps([time.time() - start_time, "sqlalchemy" in sys.modules])'])
+    times = []
+    for irepeat in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', script])
+        elapsed, sqlalchemy_loaded = json.loads(output.splitlines()[-1])
+        times.append(elapsed)
+    return times, sqlalchemy_loaded
+
+def run_benchmark(work_dir, ensemble, ntraj, tsrc_list, class_list, blocking=2,
+                  repeat=3, dup_rate=0., bad_dup_rate=0., missing_rate=0.,
+                  codec=LEGACY_CODEC):
+    """
+    Build a synthetic database in `work_dir` and time every stage of the
+    gather pipeline on it. Return the report as a dictionary.
+    """
+    db_name = os.path.join(work_dir, ensemble + '-synthetic.sqlite')
+    data_dir = os.path.join(work_dir, 'cache')
+    mass = ENSEMBLES[ensemble]['mass']
+    stages = dict()
+
+    start_time = time.time()
+    nrows = make_database(db_name, ensemble, ntraj, tsrc_list, class_list,
+                          dup_rate=dup_rate, bad_dup_rate=bad_dup_rate,
+                          missing_rate=missing_rate, codec=codec)
+    generate_time = time.time() - start_time
+
+    input_dict = {'db_name': db_name, 'data_dir': data_dir, 'ensemble': ensemble,
+                  'mass': mass, 'op_irrep': '16', 'src_class_list': class_list,
+                  'sink_class_list': class_list, 'blocking': blocking,
+                  'avg_tsrc': True, 'overwrite': False}
+    datatag = generate_tag_baryon('16', '16', class_list[0], class_list[0], '000',
+                                  mass=mass, ensemble=ensemble)
+    corr_name = _generate_correlator_keys_baryon(datatag, input_dict)[0]
+
+    stages['fetch_correlators'], rows_dict = _time(
+        lambda: fetch_correlators(db_name, [corr_name]), repeat)
+    blob_list = [row[3] for row in rows_dict[corr_name]]
+    stages['decode_blobs'], _result = _time(lambda: decode_blobs(blob_list), repeat)
+    stages['lattice_corrlator'], npt = _time(
+        lambda: Lattice_Corrlator(db_name, corr_name, datatag, 'baryon', verbose=False),
+        repeat)
+    stages['block'], _result = _time(lambda: npt.block(blocking, False), repeat)
+    stages['block_avg_tsrc'], _result = _time(lambda: npt.block(blocking, True), repeat)
+
+    def _gather_cold():
+        if os.path.isdir(data_dir):
+            shutil.rmtree(data_dir)
+        os.makedirs(data_dir)
+        return gather_dataset(input_dict)
+    stages['gather_cold'], _result = _time(_gather_cold, repeat)
+    stages['gather_warm'], (data_dict, meta_dict) = _time(
+        lambda: gather_dataset(input_dict), repeat)
+    stages['import_gather_data'], _result = _time_process('import gather_data', repeat)
+    stages['import_corr_db'], _result = _time_process('import corr_db', repeat)
+    # Cache hit of a new process, e.g. of a fit script
+    stages['gather_warm_process'], warm_sqlalchemy = _time_process(
+        'from gather_data import gather_dataset\ngather_dataset(%r)' %input_dict, repeat)
+
+    gpl_name = os.path.join(work_dir, 'bench.gpl')
+    gpl_meta_name = os.path.join(work_dir, 'bench_meta.gpl')
+    def _dump_gpl():
+        fio = open(gpl_name, 'wb')
+        fio_meta = open(gpl_meta_name, 'wb')
+        dump_gpl({datatag: data_dict[datatag]}, {datatag: meta_dict[datatag]}, fio, fio_meta)
+        fio.close()
+        fio_meta.close()
+    def _load_gpl():
+        fio = open(gpl_name, 'r')
+        fio_meta = open(gpl_meta_name, 'r')
+        result = load_gpl(fio, fio_meta)
+        fio.close()
+        fio_meta.close()
+        return result
+    stages['dump_gpl'], _result = _time(_dump_gpl, repeat)
+    stages['load_gpl'], _result = _time(_load_gpl, repeat)
+
+    report = {
+        'date': datetime.datetime.utcnow().isoformat(),
+        'host': socket.gethostname(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'sqlalchemy': sqlalchemy.__version__,
+        'parameters': {'ensemble': ensemble, 'nt': ENSEMBLES[ensemble]['nt'],
+                       'ntraj': ntraj, 'tsrc_list': list(tsrc_list),
+                       'class_list': list(class_list), 'blocking': blocking,
+                       'repeat': repeat, 'dup_rate': dup_rate,
+                       'bad_dup_rate': bad_dup_rate, 'missing_rate': missing_rate,
+                       'codec': codec,
+                       'nrows': nrows, 'db_size': os.path.getsize(db_name)},
+        'generate_time': generate_time,
+        'gather_warm_process_sqlalchemy': warm_sqlalchemy,
+        'stages': dict((stage, {'times': times, 'min': min(times),
+                                'median': float(np.median(times))})
+                       for stage, times in stages.iteritems()),
+    }
+    return report
+
+def compare_reports(report, baseline, tolerance):
+    """
+    Compare the minimum time of every stage in `report` with `baseline`.
+    Return the list of (stage, time, baseline time) of the stages that are
+    slower by more than the fraction `tolerance`.
+    """
+    regressions = []
+    for stage, timing in sorted(report['stages'].iteritems()):
+        if stage not in baseline['stages']:
+            continue
+        old = baseline['stages'][stage]['min']
+        if timing['min'] > old*(1. + tolerance):
+            regressions.append((stage, timing['min'], old))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--ensemble', default='l4864f211b600m001907m05252m6382',
+                        choices=sorted(ENSEMBLES))
+    parser.add_argument('--ntraj', type=int, default=200, help='trajectories per series')
+    parser.add_argument('--tsrc', type=int, nargs='+', default=[0, 16, 32, 48],
+                        help='time sources of every trajectory')
+    parser.add_argument('--classes', nargs='+', default=['2', '41', '61'],
+                        help='source/sink operator classes')
+    parser.add_argument('--blocking', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dup-rate', type=float, default=0.01)
+    parser.add_argument('--bad-dup-rate', type=float, default=0.)
+    parser.add_argument('--missing-rate', type=float, default=0.)
+    parser.add_argument('--codec', default=LEGACY_CODEC, choices=available_codecs(),
+                        help='encoding of the data entries')
+    parser.add_argument('--work-dir', default=None,
+                        help='directory for the synthetic database (default: temporary)')
+    parser.add_argument('--output', default=None, help='json report (default: stdout)')
+    parser.add_argument('--compare', default=None, help='json report of an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown relative to --compare')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='axialdb_bench_')
+    elif not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    try:
+        report = run_benchmark(work_dir, args.ensemble, args.ntraj, args.tsrc, args.classes,
+                               blocking=args.blocking, repeat=args.repeat,
+                               dup_rate=args.dup_rate, bad_dup_rate=args.bad_dup_rate,
+                               missing_rate=args.missing_rate, codec=args.codec)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    if args.output is None:
+        print json.dumps(report, indent=1, sort_keys=True)
+    else:
+        fio = open(args.output, 'w')
+        json.dump(report, fio, indent=1, sort_keys=True)
+        fio.close()
+        for stage, timing in sorted(report['stages'].iteritems()):
+            print '%-20s %10.4fs' %(stage, timing['min'])
+
+    if args.compare is not None:
+        fio = open(args.compare, 'r')
+        baseline = json.load(fio)
+        fio.close()
+        regressions = compare_reports(report, baseline, args.tolerance)
+        for stage, new, old in regressions:
+            print 'REGRESSION: %s took %.4fs (was %.4fs)' %(stage, new, old)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
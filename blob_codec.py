@@ -0,0 +1,93 @@
+"""
+Encodings of the correlator data stored in the dataBZ2 column.
+
+Datum stores a correlator as its values in decimal text, joined by newlines
+and compressed with bz2 ('bz2text'). Reading it back needs both bz2 and
+string to float parsing. The other codecs store the raw little endian
+float64 bytes, optionally byte-shuffled (the k-th bytes of all values are
+stored together, which compresses much better), compressed by zlib, bz2 or,
+if the lzma module is available, lzma.
+
+A non-legacy entry starts with a short header,
+
+    MAGIC + version + codec id + shuffle flag
+
+and legacy entries always start with the bz2 stream header 'BZh', so the
+codec of every entry is known without a schema change and old and new
+entries can be mixed in one database.
+"""
+import bz2
+import zlib
+import numpy as np
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+MAGIC = '\x00AXC'
+CODEC_VERSION = '\x01'
+LEGACY_CODEC = 'bz2text'
+
+# codec name: (id in the header, compress, decompress)
+_CODECS = {
+    'zlib': ('z', lambda data: zlib.compress(data, 6), zlib.decompress),
+    'bz2': ('b', lambda data: bz2.compress(data, 9), bz2.decompress),
+}
+if lzma is not None:
+    _CODECS['lzma'] = ('x', lzma.compress, lzma.decompress)
+_CODEC_IDS = dict((codec_id, name) for name, (codec_id, compress, decompress)
+                  in _CODECS.iteritems())
+_HEADER_SIZE = len(MAGIC) + 3
+
+def available_codecs():
+    """
+    Return the names of all codecs that can be used here.
+    """
+    return [LEGACY_CODEC] + sorted(_CODECS)
+
+def blob_codec(blob):
+    """
+    Return the name of the codec of a dataBZ2 entry (a string or a buffer)
+    and whether it is byte-shuffled.
+    """
+    if blob[:len(MAGIC)] != MAGIC:
+        return LEGACY_CODEC, False
+    if blob[len(MAGIC)] != CODEC_VERSION:
+        raise ValueError('Unknown codec version %s!' %ord(blob[len(MAGIC)]))
+    codec_id = blob[len(MAGIC)+1]
+    if codec_id not in _CODEC_IDS:
+        raise ValueError('Unknown or unavailable codec id %s!' %repr(codec_id))
+    return _CODEC_IDS[codec_id], blob[len(MAGIC)+2] == '1'
+
+def encode_blob(data, codec='zlib', shuffle=True):
+    """
+    Encode the values in `data` as a dataBZ2 entry with `codec`. The legacy
+    codec formats the values with repr(), which reads back to the same
+    float64 values.
+    """
+    if codec == LEGACY_CODEC:
+        return bz2.compress('\n'.join([repr(float(x)) for x in data]), 9)
+    if codec not in _CODECS:
+        raise ValueError('Unknown or unavailable codec %s!' %codec)
+    raw = np.ascontiguousarray(data, dtype='<f8')
+    if shuffle:
+        raw = np.ascontiguousarray(raw.view(np.uint8).reshape(-1, 8).T)
+    codec_id, compress, decompress = _CODECS[codec]
+    return MAGIC + CODEC_VERSION + codec_id + str(int(bool(shuffle))) + \
+        compress(raw.tostring())
+
+def decode_blob(blob):
+    """
+    Decode a dataBZ2 entry of any codec into a float64 array.
+    """
+    codec, shuffle = blob_codec(blob)
+    if codec == LEGACY_CODEC:
+        return np.array(bz2.decompress(blob).split('\n'),dtype=np.float64)
+    codec_id, compress, decompress = _CODECS[codec]
+    raw = np.frombuffer(decompress(blob[_HEADER_SIZE:]), dtype=np.uint8)
+    if shuffle:
+        raw = raw.reshape(8, -1).T.copy()
+    return raw.view('<f8').reshape(-1).astype(np.float64)
@@ -0,0 +1,147 @@
+"""
+Bookkeeping of the data cache files written by gather_data. Every data
+directory holds a manifest that records, for each cache file, the fingerprint
+of the database it was built from and of the query that produced it, so that
+a cache file is only rebuilt when one of them changes. Least recently used
+cache files are evicted when the directory grows over a disk budget.
+"""
+import os
+import time
+import json
+import fcntl
+import hashlib
+import contextlib
+
+MANIFEST_NAME = 'cache_manifest.json'
+# Bump to invalidate all existing cache files after a change in the output
+CACHE_VERSION = 1
+
+def load_manifest(data_dir):
+    """
+    Read the manifest in `data_dir`. Return an empty manifest if there is
+    none or if it cannot be read.
+    """
+    manifest_name = os.path.join(data_dir, MANIFEST_NAME)
+    if not os.path.isfile(manifest_name):
+        return dict()
+    try:
+        fio = open(manifest_name, 'r')
+        manifest = json.load(fio)
+        fio.close()
+    except ValueError:
+        print 'WARNING: Cannot read cache manifest %s. Starting a new one.' %manifest_name
+        manifest = dict()
+    return manifest
+
+def save_manifest(data_dir, manifest):
+    """
+    Write the manifest to `data_dir`. The file is replaced atomically so that
+    a reader never sees a partially written manifest.
+    """
+    manifest_name = os.path.join(data_dir, MANIFEST_NAME)
+    tmp_name = manifest_name + '.%s.tmp' %os.getpid()
+    fio = open(tmp_name, 'w')
+    json.dump(manifest, fio, indent=1, sort_keys=True)
+    fio.close()
+    os.rename(tmp_name, manifest_name)
+
+@contextlib.contextmanager
+def locked_manifest(data_dir):
+    """
+    Read the manifest in `data_dir` while holding an exclusive lock on it and
+    save it when the block ends, so that several processes gathering into
+    the same directory do not lose each other's entries.
+    """
+    lock = open(os.path.join(data_dir, MANIFEST_NAME + '.lock'), 'a')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        manifest = load_manifest(data_dir)
+        yield manifest
+        save_manifest(data_dir, manifest)
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+def query_fingerprint(datatag, key_list, input_dict, out_format):
+    """
+    Return a fingerprint of all parameters that determine the content of
+    the cache file of datatag.
+    """
+    query = {'version': CACHE_VERSION,
+             'db_name': os.path.abspath(input_dict['db_name']),
+             'datatag': datatag,
+             'key_list': list(key_list),
+             'avg_tsrc': bool(input_dict['avg_tsrc']),
+             'blocking': str(input_dict['blocking']),
+             'out_format': out_format}
+    return hashlib.md5(json.dumps(query, sort_keys=True)).hexdigest()
+
+def is_fresh(manifest, save_name, db_fp, query_fp):
+    """
+    Return True if the cache file `save_name` was built from a database with
+    fingerprint `db_fp` by a query with fingerprint `query_fp`.
+    """
+    entry = manifest.get(os.path.basename(save_name))
+    if entry is None:
+        return False
+    return entry['db_fingerprint'] == db_fp and entry['query_fingerprint'] == query_fp
+
+def record_entry(manifest, save_name, meta_save_name, db_fp, query_fp, extra_files=()):
+    """
+    Add the freshly written cache files `save_name` and `meta_save_name` to
+    the manifest. `extra_files` are other files that belong to the entry and
+    are evicted together with it.
+    """
+    files = [save_name, meta_save_name] + list(extra_files)
+    manifest[os.path.basename(save_name)] = {
+        'files': [os.path.basename(file_name) for file_name in files],
+        'size': sum(os.path.getsize(file_name) for file_name in files),
+        'db_fingerprint': db_fp,
+        'query_fingerprint': query_fp,
+        'last_access': time.time()}
+
+def touch_entry(save_name):
+    """
+    Mark the cache file `save_name` as used now. The access time of the file
+    is set instead of rewriting the manifest, so that cache hits need no lock
+    and also work in a directory that cannot be written to. This is only
+    best-effort: if the time cannot be set, the entry keeps its old one.
+    """
+    try:
+        os.utime(save_name, (time.time(), os.path.getmtime(save_name)))
+    except (IOError, OSError):
+        pass
+
+def last_access(data_dir, name, entry):
+    """
+    Return the time the cache file `name` was last used: the later of the
+    time in its manifest entry and the access time set by touch_entry.
+    """
+    try:
+        return max(entry['last_access'], os.path.getatime(os.path.join(data_dir, name)))
+    except OSError:
+        return entry['last_access']
+
+def evict_entries(data_dir, manifest, budget, keep=()):
+    """
+    Delete the least recently used cache files in `data_dir` until the
+    total size of the files in the manifest is at most `budget` bytes.
+    Entries in `keep` are never deleted. Return the list of evicted entries.
+    """
+    keep = [os.path.basename(i) for i in keep]
+    total = sum(entry['size'] for entry in manifest.itervalues())
+    evicted = []
+    for name in sorted(manifest, key=lambda name: last_access(data_dir, name, manifest[name])):
+        if total <= budget:
+            break
+        if name in keep:
+            continue
+        for file_name in manifest[name]['files']:
+            file_name = os.path.join(data_dir, file_name)
+            if os.path.isfile(file_name):
+                os.remove(file_name)
+        total -= manifest[name]['size']
+        del manifest[name]
+        evicted.append(name)
+        print 'Evicted cache file %s' %name
+    return evicted
@@ -1,107 +1,649 @@
 from sqlalchemy import *
-import math, bz2
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+import math, bz2, itertools
+import os, sys
+import threading, atexit, collections
+import sqlite3
+from urllib import quote
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
-import yaml
 from DB import *
+from blob_codec import decode_blob
+from metrics import stage, tagged
+from corr_meta import *
+from corr_meta import _parse_configId, _entry_configId
 
-########################################################################
-"""
-From utilies.py
-"""
-
-def readin_stream(input_stream):
-    """
-    Utility to either read in yaml file or dictionary. Return dictionary in both
-    cases. The yaml file can contain multiple documents, and if this is the case,
-    it will return a list of all dictionary for each document.
-    """
-    if isinstance(input_stream, str):
-        if input_stream.endswith('.yaml'):
-            try:
-                stream = file(input_stream, 'r')
-                param_dict = yaml.load(stream)
-                default_dict = param_dict #based default param
-            except:
-                try:
-                    stream = file(input_stream, 'r')
-                    param_dict = yaml.load_all(stream)
-                    default_dict = [i for i in param_dict] # List of dictionary of each document
-                except:
-                    raise ValueError('Cannot open file %s '%input_stream)
-        else:
-            raise ValueError('Unknow suffix for file %s'%input_stream)
+# Pragmas of tuned read-only connections: memory-map up to 1 GiB of the file,
+# cache up to 256 MiB of pages and keep temporary sort tables in memory
+TUNED_PRAGMAS = [('mmap_size', 1<<30), ('cache_size', -262144), ('temp_store', 'MEMORY')]
+
+def _sqlite_uri():
+    """
+    Return True if sqlite3.connect accepts uri=True (Python >= 3.4).
+    """
+    return sys.version_info >= (3, 4) and sqlite3.sqlite_version_info >= (3, 7, 13)
+
+def _read_only_engine(db_name, tuned=False):
+    """
+    Create an engine for `db_name` whose connections cannot modify the
+    database, so that gathers can safely run side by side.
+
+    If `tuned` is set, the connections use TUNED_PRAGMAS and, where the
+    sqlite3 module supports URI filenames, open the file with
+    mode=ro&immutable=1 so that SQLite skips all locking. Only use this on
+    databases that are not written to while they are read.
+
+    Connections are pooled, and every checkout is used by one thread at a
+    time, so they may be shared between threads.
+    """
+    pool_args = {'poolclass': QueuePool, 'pool_size': 5, 'max_overflow': -1}
+    if tuned and _sqlite_uri():
+        uri = 'file:%s?mode=ro&immutable=1' %quote(os.path.abspath(db_name))
+        engine = create_engine('sqlite://', creator=lambda: sqlite3.connect(
+            uri, uri=True, check_same_thread=False), **pool_args)
     else:
-        default_dict = input_stream
-    return default_dict
-
-def generate_tag_baryon(src_irrep, sink_irrep, src_class, sink_class, mom, mass,
-                 ensemble):
-    """
-    Generate data tags for particular correlator keys to identify them in
-    corrfitter. The goal is that we want the tags it generated only has
-    information about the irreps we use for src/sink, the classes of those
-    corresponding src/sink operators, the momentum for each quark, mass for
-    each quark, and the ensemble we used.
-
-    Possible list of src/sink_irrep:
-        '8p': 8 irrep (fundamental)
-        '8m': 8 prime irrep
-        '16p'&'16m': 16 irrep (p/m represents plus/minus eigenvalues of R12)
-                     This will not work with gather_data routine
-        '16': 16 irrep. This will work with gather_data routine
-
-    This is used for both tagging the data in corrfitter and the file names
-    for the pickle files.
-    """
-
-    #assume momentum are same for all three if string provided
-    if isinstance(mom, str):
-        if len(mom) != 3:
-            raise
-        mom = (mom,mom,mom)
-
-    if src_irrep != sink_irrep:
-        #I should only give one irrep choice..
-        raise ValueError('source irrep must be identical to sink irrep!')
-
-    group_construct = '%s_s_%s_%s_s_%s_'%(
-            src_irrep, src_class, sink_irrep, sink_class)
-    mom_construct = 'p%s_p%s_p%s_'%(mom[0], mom[1], mom[2])
-    mass_construct = 'm%s_m%s_m%s_'%(mass,mass,mass) #same masses for all
-
-    return group_construct + mom_construct + mass_construct + ensemble
-
-def parse_tag_baryon(datatag):
-    """
-    Inverse of generate_tag. Given datatag, return library with keys of
-        (src_irrep, sink_irrep, src_class, sink_class, mom, mass, ensemble)
-    """
-    datatag_split = datatag.split('_')
-    src_irrep  = datatag_split[0]
-    src_class  = datatag_split[2]
-    sink_irrep = datatag_split[3]
-    sink_class = datatag_split[5]
-    mom0       = (datatag_split[6])[1:]
-    mom1       = (datatag_split[7])[1:]
-    mom2       = (datatag_split[8])[1:]
-    mom        = (mom0,mom1,mom2)
-    mass       = float((datatag_split[9])[1:])
-    ensemble   = datatag_split[12]
-
-    data_dict = dict()
-    data_dict['src_irrep']  = src_irrep
-    data_dict['sink_irrep'] = sink_irrep
-    data_dict['src_class']  = src_class
-    data_dict['sink_class'] = sink_class
-    data_dict['mom']        = mom
-    data_dict['mass']       = mass
-    data_dict['ensemble']   = ensemble
-    return data_dict
+        engine = create_engine('sqlite:///'+db_name,
+                               connect_args={'check_same_thread': False}, **pool_args)
+    @event.listens_for(engine, 'connect')
+    def _query_only(dbapi_connection, connection_record):
+        dbapi_connection.execute('PRAGMA query_only = ON')
+        if tuned:
+            for pragma, value in TUNED_PRAGMAS:
+                dbapi_connection.execute('PRAGMA %s = %s' %(pragma, value))
+    return engine
+
+# Registry of read-only engines, see get_engine
+_engines = dict()
+_engines_lock = threading.Lock()
+_engines_pid = os.getpid()
+_forked_engines = []
+
+def _file_identity(db_name):
+    """
+    Return what identifies the current version of the file `db_name`.
+    """
+    st = os.stat(db_name)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+def get_engine(db_name, tuned=False):
+    """
+    Return the shared read-only engine of `db_name` (see _read_only_engine),
+    so that all reads in a process reuse the same pooled connections and
+    their page caches. The registry is keyed by the absolute path of the
+    database and `tuned`, and is safe to use from several threads.
+
+    An engine is replaced when the file is replaced or modified, and all
+    engines are replaced in a forked child process; the connections
+    inherited from the parent are never used or closed there. Connections
+    are closed by close_engines, which also runs at exit.
+    """
+    global _engines_pid
+    key = (os.path.abspath(db_name), bool(tuned))
+    identity = _file_identity(db_name)
+    with _engines_lock:
+        if os.getpid() != _engines_pid:
+            # Keep the parent's connections alive: closing an SQLite
+            # connection inherited through fork is not safe
+            _forked_engines.extend(engine for engine, file_identity in _engines.itervalues())
+            _engines.clear()
+            _engines_pid = os.getpid()
+        if key in _engines:
+            engine, file_identity = _engines[key]
+            if file_identity == identity:
+                return engine
+            engine.dispose()
+        engine = _read_only_engine(db_name, tuned=tuned)
+        _engines[key] = (engine, identity)
+        return engine
+
+def close_engines(db_name=None):
+    """
+    Close the pooled connections of the shared engines of `db_name`, or of
+    all databases if `db_name` is None.
+    """
+    with _engines_lock:
+        if os.getpid() != _engines_pid:
+            return
+        for key in _engines.keys():
+            if db_name is None or key[0] == os.path.abspath(db_name):
+                engine, file_identity = _engines.pop(key)
+                engine.dispose()
+
+atexit.register(close_engines)
+
+def _correlator_query(corr_names):
+    """
+    Query of the ids of the correlators in `corr_names`.
+    """
+    corr_table = Correlator.__table__
+    return select([corr_table.c.id, corr_table.c.name]).where(
+        corr_table.c.name.in_(corr_names))
+
+def _data_query(name_dict, after_id=None):
+    """
+    Query of all data entries of the correlators in `name_dict` (ids as keys
+    and names as values), ordered by correlator, series, trajectory and tsrc.
+    See fetch_correlators for `after_id`.
+    """
+    data_table = Datum.__table__
+    condition = data_table.c.correlator_id.in_(name_dict.keys())
+    if after_id is not None:
+        # The IN condition is redundant but lets SQLite search the index
+        condition = and_(condition, or_(*[and_(data_table.c.correlator_id == corr_id,
+                                               data_table.c.id > after_id.get(name, -1))
+                                          for corr_id, name in name_dict.iteritems()]))
+    return select([data_table.c.correlator_id,
+                   data_table.c.series,
+                   data_table.c.trajectory,
+                   data_table.c.tsrc,
+                   data_table.c.dataBZ2,
+                   data_table.c.id]).where(condition).order_by(
+                   data_table.c.correlator_id,
+                   data_table.c.series,
+                   data_table.c.trajectory,
+                   data_table.c.tsrc,
+                   data_table.c.id)
+
+def _stream_query(corr_id):
+    """
+    Query of the data entries of the correlator `corr_id` in (series,
+    trajectory, tsrc) order, as read by stream_blocks.
+    """
+    data_table = Datum.__table__
+    return select([data_table.c.series,
+                   data_table.c.trajectory,
+                   data_table.c.tsrc,
+                   data_table.c.dataBZ2]).where(
+                   data_table.c.correlator_id == corr_id).order_by(
+                   data_table.c.series,
+                   data_table.c.trajectory,
+                   data_table.c.tsrc,
+                   data_table.c.id)
+
+def _correlator_ids(conn, corr_names):
+    """
+    Resolve `corr_names` with one IN lookup on the connection `conn`.
+    Return a dictionary with correlator ids as keys and names as values.
+    """
+    name_dict = dict()
+    with stage('lookup', correlators=len(corr_names)):
+        for corr_id, name in conn.execute(_correlator_query(corr_names)):
+            if name in name_dict.values():
+                raise ValueError("Error in retrieving '%s': more than more entries present in " %name +
+                                 "Correlator Column")
+            name_dict[corr_id] = name
+    for name in corr_names:
+        if name not in name_dict.values():
+            raise ValueError("Cannot find '%s' in Correlator Column" %name)
+    return name_dict
+
+def fetch_correlators(db_name, corr_names, after_id=None, tuned=False):
+    """
+    Bulk query all data entries of the correlators in `corr_names` with a
+    single connection. Correlator names are resolved with one IN lookup and
+    only the (correlator_id, series, trajectory, tsrc, dataBZ2, id) columns of
+    the data table are streamed through SQLAlchemy Core, so no ORM objects are
+    created. If `after_id` is given, it is a dictionary with correlator names
+    as keys and only entries with a larger data id are returned. `tuned` is
+    passed to get_engine.
+
+    Return a dictionary with correlator names as keys and lists of
+    (series, trajectory, tsrc, dataBZ2, id) tuples, ordered by series,
+    trajectory and tsrc, as values.
+    """
+    corr_names = list(corr_names)
+    with stage('fetch', correlators=len(corr_names)) as record:
+        conn = get_engine(db_name, tuned=tuned).connect()
+        try:
+            name_dict = _correlator_ids(conn, corr_names) # correlator_id -> name
+            rows_dict = dict((name, []) for name in corr_names)
+            query = _data_query(name_dict, after_id=after_id)
+            result = conn.execution_options(stream_results=True).execute(query)
+            nbytes = 0
+            for corr_id, series, trajectory, tsrc, dataBZ2, data_id in result:
+                rows_dict[name_dict[corr_id]].append((series, trajectory, tsrc, dataBZ2, data_id))
+                nbytes += len(dataBZ2)
+        finally:
+            conn.close()
+        record['rows'] = sum(len(rows) for rows in rows_dict.itervalues())
+        record['bytes'] = nbytes
+    return rows_dict
+
+def _decode_blob(dataBZ2):
+    """
+    Decode one dataBZ2 entry of any codec in blob_codec into a numpy array.
+    """
+    return decode_blob(dataBZ2)
+
+def _decode_chunk(blob_list):
+    """
+    Decode a list of dataBZ2 entries into a (len(blob_list), nt) array.
+    """
+    if len(blob_list) == 0:
+        return np.zeros([0, 0])
+    first = _decode_blob(blob_list[0])
+    chunk = np.empty([len(blob_list), len(first)], dtype=np.float64)
+    chunk[0,:] = first
+    _copy_rows(chunk, 1, [_decode_blob(dataBZ2) for dataBZ2 in blob_list[1:]])
+    return chunk
+
+def _copy_rows(out, start, data_list):
+    """
+    Copy the decoded rows in `data_list` into `out` starting at row `start`.
+    `data_list` is either a list of arrays or a 2D array.
+    """
+    nt = np.shape(out)[1]
+    for indx, idata in enumerate(data_list):
+        if len(idata) != nt:
+            raise ValueError('Some data have inconsistent self.nt! (%s != %s)'
+                             %(len(idata),nt))
+        out[start+indx,:] = idata
+
+def decode_blobs(blob_list, workers=None, pool_type='thread', chunk_size=None):
+    """
+    Decompress and decode a list of dataBZ2 entries into a preallocated
+    (nrows, nt) float64 array.
+
+    If `workers` is larger than one, the entries are decoded in chunks of
+    `chunk_size` rows by a pool of `workers` threads (`pool_type`='thread')
+    or processes (`pool_type`='process'). The text is parsed exactly as in the
+    serial path, so the results are bit-identical.
+    """
+    with stage('decode', rows=len(blob_list), workers=workers or 1) as record:
+        record['bytes'] = sum(len(dataBZ2) for dataBZ2 in blob_list)
+        return _decode_blobs(blob_list, workers, pool_type, chunk_size)
+
+def _decode_blobs(blob_list, workers, pool_type, chunk_size):
+    if pool_type != 'thread' and pool_type != 'process':
+        raise ValueError("pool_type needs to be thread or process!")
+    nrows = len(blob_list)
+    if nrows == 0:
+        raise ValueError("Nothing to decode!")
+    if workers is None or workers <= 1 or nrows == 1:
+        return _decode_chunk(blob_list)
+
+    first = _decode_blob(blob_list[0])
+    out = np.empty([nrows, len(first)], dtype=np.float64)
+    out[0,:] = first
+
+    if chunk_size is None:
+        chunk_size = max(1, (nrows-1)//(4*workers) + 1)
+    chunk_start = range(1, nrows, chunk_size)
+    if pool_type == 'thread':
+        # Threads write straight into out; bz2 and zlib release the GIL while
+        # decompressing
+        def _decode_into(start):
+            _copy_rows(out, start, [_decode_blob(dataBZ2)
+                                    for dataBZ2 in blob_list[start:start+chunk_size]])
+        pool = ThreadPool(workers)
+        try:
+            pool.map(_decode_into, chunk_start)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for start, data_list in zip(chunk_start, pool.imap(_decode_chunk,
+                    [blob_list[start:start+chunk_size] for start in chunk_start])):
+                _copy_rows(out, start, data_list)
+        finally:
+            pool.close()
+            pool.join()
+    return out
+
+def _compare_duplicates(idataa, idatab, iconfiga, indx_list, verbose=True):
+    """
+    Compare the entry `idataa` with the other entries `idatab` (a 2D array)
+    of the same configuration `iconfiga`, all at once. `indx_list` holds the
+    row indices of all these entries for the warnings. Return True if they
+    are all identical up to the tolerance, in which case only the first one
+    should be retained; otherwise the configuration should be discarded.
+    """
+    tolerance = 1e-4 # Maximum tolerance for percentage difference
+    pdiff = np.sum(((idataa - idatab)/idataa), axis=1)/len(idataa) # average percent difference
+    maxdiff = np.max((idataa - idatab)/idatab, axis=1)
+    not_identical = (np.abs(maxdiff) > tolerance) | (np.abs(pdiff) > tolerance)
+    if verbose:
+        for icb, imaxdiff, ipdiff, inot_identical in zip(indx_list[1:], maxdiff, pdiff,
+                                                         not_identical):
+            if inot_identical:
+                print "------------------------------------------------------------------"
+                print "*****WARNING****** Correlators from two configurations found " +\
+                        "but NOT identical (%s)!" %iconfiga
+                print "max percent diff: %s, average percent diff: %s" %(imaxdiff, ipdiff)
+                print "This configuration will be all discarded!"
+                print indx_list[0], icb
+                print "------------------------------------------------------------------"
+            else:
+                # If two correlator entries are identical up to specified tolerance, for the same configuration
+                # we only keep one of them
+                print '--> WARNING: Identical data present: %s vs %s Only one will be retained.' %(iconfiga, iconfiga)
+    return not np.any(not_identical)
+
+def _identical_rows(flat_data, flat_block):
+    """
+    Return True if two rows of `flat_data` that belong to the same block
+    according to `flat_block` are identical. Identical rows have the same row
+    sum, so only rows that share block and row sum are compared element by
+    element.
+    """
+    flat_sum = np.sum(flat_data, axis=1)
+    order = np.lexsort((flat_sum, flat_block))
+    collide = np.flatnonzero((flat_block[order][1:] == flat_block[order][:-1])
+                             & (flat_sum[order][1:] == flat_sum[order][:-1]))
+    candidates = dict()
+    for indx in np.unique(np.concatenate([order[collide], order[collide+1]])):
+        candidates.setdefault((flat_block[indx], flat_sum[indx]), []).append(indx)
+    for candidate in candidates.itervalues():
+        for dk in candidate:
+            for uk in candidate:
+                if dk < uk and np.array_equal(flat_data[dk], flat_data[uk]):
+                    return True
+    return False
+
+def _block_starts(series, tblock_no):
+    """
+    Return the index of the first entry of every block when consecutive
+    entries of the same `series` are grouped into blocks of tblock_no
+    entries. The trailing entries of every series that do not fill up a
+    whole block are not used.
+    """
+    if len(series) == 0:
+        return np.zeros(0, dtype=int)
+    # Split into runs of the same series and count the blocks in each run
+    run_start = np.flatnonzero(np.concatenate([[True], series[1:] != series[:-1]]))
+    run_len = np.diff(np.concatenate([run_start, [len(series)]]))
+    run_block_no = run_len//tblock_no
+
+    # First entry of every block, counted from the start of its run
+    block_run = np.repeat(np.arange(len(run_start)), run_block_no)
+    block_in_run = np.arange(len(block_run)) - np.repeat(np.cumsum(run_block_no) - run_block_no,
+                                                         run_block_no)
+    return run_start[block_run] + block_in_run*tblock_no
+
+def integrated_autocorr_time(units, series, window_factor=6.0):
+    """
+    Return the integrated autocorrelation time of every timeslice of the
+    (nunit, nt) array `units`, in units of entries, its statistical error
+    and the summation window. The autocorrelation function is measured
+    within every series only and summed up to the first window W with
+    W >= window_factor * tau(W) (Madras and Sokal).
+    """
+    units = np.asarray(units, dtype=np.float64)
+    nunit, nt = np.shape(units)
+    centered = units - np.mean(units, axis=0)
+    gamma = np.zeros([nunit, nt])
+    pairs = np.zeros(nunit)
+    run_start = np.flatnonzero(np.concatenate([[True], series[1:] != series[:-1]]))
+    for start, end in zip(run_start, np.concatenate([run_start[1:], [nunit]])):
+        # Autocorrelation of the run by FFT, padded against wrap-around
+        run_len = end - start
+        fft = np.fft.rfft(centered[start:end], n=2*run_len, axis=0)
+        gamma[:run_len] += np.fft.irfft(np.abs(fft)**2, n=2*run_len, axis=0)[:run_len]
+        pairs[:run_len] += run_len - np.arange(run_len)
+    max_lag = max(int(np.count_nonzero(pairs))//2, 1)
+    gamma = gamma[:max_lag]/pairs[:max_lag,None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rho = gamma/gamma[0]
+    tau = 0.5 + np.concatenate([np.zeros([1, nt]), np.cumsum(rho[1:], axis=0)])
+    # tau[W] sums the autocorrelation up to lag W
+    lags = np.arange(max_lag)[:,None]
+    with np.errstate(invalid='ignore'):
+        stop = (lags >= window_factor*tau) & (lags > 0)
+    window = np.where(np.any(stop, axis=0), np.argmax(stop, axis=0), max_lag - 1)
+    tau_int = tau[window, np.arange(nt)]
+    tau_error = tau_int*np.sqrt(2.*(2*window + 1)/nunit)
+    return tau_int, tau_error, window
+
+def blocking_sweep(units, series, block_sizes, window_factor=6.0):
+    """
+    Block the (nunit, nt) array `units` with every block size in
+    `block_sizes` in one pass. Consecutive units of the same series are
+    grouped as in Lattice_Corrlator.block, and all block means are taken
+    from one cumulative sum, so they agree with block up to rounding.
+    Return a dictionary with
+        'block_sizes': the block sizes
+        'nblock': number of blocks of every block size
+        'mean', 'error': (len(block_sizes), nt) arrays of the mean of the
+            blocks and its standard error
+        'tau_block': (len(block_sizes), nt) estimate of the integrated
+            autocorrelation time, (error / error without blocking)**2 / 2,
+            which levels off once the blocks are independent
+        'tau_int', 'tau_int_error', 'window': integrated autocorrelation
+            time of every timeslice in units, see integrated_autocorr_time
+    """
+    units = np.asarray(units, dtype=np.float64)
+    nunit, nt = np.shape(units)
+    cumsum = np.concatenate([np.zeros([1, nt]), np.cumsum(units, axis=0)])
+
+    def _blocked(block_size):
+        starts = _block_starts(series, block_size)
+        means = (cumsum[starts + block_size] - cumsum[starts])/block_size
+        if len(means) > 1:
+            error = np.std(means, axis=0, ddof=1)/np.sqrt(len(means))
+        else:
+            error = np.nan*np.ones(nt)
+        return len(means), np.mean(means, axis=0), error
+
+    nblock_1, mean_1, error_1 = _blocked(1)
+    sweep = {'block_sizes': list(block_sizes), 'nblock': [], 'mean': [], 'error': []}
+    for block_size in block_sizes:
+        nblock, mean, error = _blocked(int(block_size))
+        sweep['nblock'].append(nblock)
+        sweep['mean'].append(mean)
+        sweep['error'].append(error)
+    sweep['nblock'] = np.array(sweep['nblock'], dtype=int)
+    sweep['mean'] = np.array(sweep['mean']).reshape(-1, nt)
+    sweep['error'] = np.array(sweep['error']).reshape(-1, nt)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sweep['tau_block'] = 0.5*(sweep['error']/error_1)**2
+    sweep['tau_int'], sweep['tau_int_error'], sweep['window'] = \
+        integrated_autocorr_time(units, series, window_factor=window_factor)
+    return sweep
+
+def _stream_correlator(conn, corr_id, verbose=True):
+    """
+    Stream the entries of the correlator `corr_id` in (series, trajectory,
+    tsrc) order from a server-side cursor on `conn`. Duplicate entries of
+    the same configuration are handled as in Lattice_Corrlator. Yield
+    (series, trajectory, tsrc, data) for every retained entry.
+    """
+    result = conn.execution_options(stream_results=True).execute(_stream_query(corr_id))
+    group_key = None
+    group = []
+    indx = 0
+    for series, trajectory, tsrc, dataBZ2 in itertools.chain(result, [(None, None, None, None)]):
+        key = (series, trajectory, tsrc)
+        if key != group_key and len(group) > 0:
+            # All entries of the previous configuration are read
+            iconfig = '%s%s_t%s'%(group_key[0], str(group_key[1]).zfill(5),
+                                  str(group_key[2]).zfill(3))
+            if len(group) == 1 or _compare_duplicates(group[0], np.array(group[1:]), iconfig,
+                                                      range(indx-len(group), indx), verbose=verbose):
+                yield group_key + (group[0],)
+            group = []
+        if series is None:
+            break
+        group_key = key
+        group.append(_decode_blob(dataBZ2))
+        indx += 1
+
+def _discarded_configurations(conn, corr_id):
+    """
+    Return the set of (series, trajectory, tsrc) of the configurations of
+    the correlator `corr_id` whose duplicate entries are not identical, and
+    that _stream_correlator therefore discards. Only the entries of
+    configurations with more than one entry are read and decoded.
+    """
+    data_table = Datum.__table__
+    keys = [data_table.c.series, data_table.c.trajectory, data_table.c.tsrc]
+    duplicates = select(keys).where(data_table.c.correlator_id == corr_id).group_by(
+        *keys).having(func.count() > 1).alias()
+    query = select(keys + [data_table.c.dataBZ2]).select_from(data_table.join(
+        duplicates, and_(*[column == duplicates.c[column.name] for column in keys]))).where(
+        data_table.c.correlator_id == corr_id).order_by(*(keys + [data_table.c.id]))
+    discarded = set()
+    for key, group in itertools.groupby(conn.execute(query), key=lambda row: tuple(row[:3])):
+        group = [_decode_blob(dataBZ2) for series, trajectory, tsrc, dataBZ2 in group]
+        iconfig = '%s%s_t%s'%(key[0], str(key[1]).zfill(5), str(key[2]).zfill(3))
+        if not _compare_duplicates(group[0], np.array(group[1:]), iconfig,
+                                   range(len(group)), verbose=False):
+            discarded.add(key)
+    return discarded
+
+def _complete_trajectories(rows, no_tsrc):
+    """
+    Pass on the (series, trajectory, tsrc, ...) tuples of `rows` except for
+    trajectories with fewer than `no_tsrc` entries. Only one trajectory is
+    held at a time.
+    """
+    traj_rows = []
+    for row in itertools.chain(rows, [(None, None)]):
+        if len(traj_rows) > 0 and row[:2] != traj_rows[0][:2]:
+            if len(traj_rows) >= no_tsrc:
+                for traj_row in traj_rows:
+                    yield traj_row
+            traj_rows = []
+        traj_rows.append(row)
+
+def stream_blocks(db_name, corr_names, block_no, avg_tsrc, drop_incomplete=False,
+                  verbose=True, tuned=False):
+    """
+    Streaming version of Lattice_Corrlator.block that never holds more than
+    one block in memory. The entries of every correlator in `corr_names`
+    are read in (series, trajectory, tsrc) order from server-side cursors,
+    blocked exactly as in Lattice_Corrlator.block and averaged over the
+    correlators (e.g. 16p and 16m). All correlators need to have the same
+    configurations.
+
+    The number of time sources per configuration is counted in the database
+    beforehand, without the configurations whose conflicting duplicate
+    entries are discarded (see _discarded_configurations), so it is the
+    number Lattice_Corrlator finds.
+
+    `tuned` is passed to get_engine. Yield (configId, data) for every
+    block.
+    """
+    corr_names = list(corr_names)
+    data_table = Datum.__table__
+    conn = get_engine(db_name, tuned=tuned).connect()
+    try:
+        name_dict = _correlator_ids(conn, corr_names)
+        id_dict = dict((name, corr_id) for corr_id, name in name_dict.iteritems())
+
+        # Count time sources per configuration as in Lattice_Corrlator
+        no_tsrc_list = []
+        for name in corr_names:
+            condition = data_table.c.correlator_id == id_dict[name]
+            n_rows = conn.execute(select([func.count()]).select_from(
+                select([data_table.c.series, data_table.c.trajectory, data_table.c.tsrc]).where(
+                condition).distinct().alias())).scalar()
+            n_unique = conn.execute(select([func.count()]).select_from(
+                select([data_table.c.series, data_table.c.trajectory]).where(
+                condition).distinct().alias())).scalar()
+            if n_unique == 0:
+                raise ValueError("No data found for correlator '%s'" %name)
+            # Leave out the configurations that are discarded while streaming,
+            # and the trajectories that have no other configurations
+            discarded = _discarded_configurations(conn, id_dict[name])
+            n_rows -= len(discarded)
+            discarded_traj = collections.Counter((series, trajectory)
+                                                 for series, trajectory, tsrc in discarded)
+            for (series, trajectory), n_discarded in discarded_traj.iteritems():
+                n_tsrc = conn.execute(select([func.count(distinct(data_table.c.tsrc))]).where(
+                    and_(condition, data_table.c.series == series,
+                         data_table.c.trajectory == trajectory))).scalar()
+                if n_tsrc == n_discarded:
+                    n_unique -= 1
+            if n_unique == 0:
+                raise ValueError("All configurations of correlator '%s' were discarded as " %name +
+                                 "conflicting duplicates")
+            no_tsrc_list.append(int(math.floor(float(n_rows)/float(n_unique))))
+        if no_tsrc_list.count(no_tsrc_list[0]) != len(no_tsrc_list):
+            raise ValueError('Error in gathering data! Possible errors in generating data!')
+        no_tsrc = no_tsrc_list[0]
+        if avg_tsrc:
+            _tblock_no = block_no * no_tsrc
+        else:
+            _tblock_no = block_no
+
+        streams = [_stream_correlator(conn, id_dict[name], verbose=verbose)
+                   for name in corr_names]
+        counts = {'n_rows': 0, 'n_unique': 0, 'nt': None}
+        def _merged_rows():
+            # Walk through the correlators in lockstep
+            last_series_traj = None
+            for entries in itertools.izip_longest(*streams):
+                if None in entries or len(set(entry[:3] for entry in entries)) != 1:
+                    raise ValueError('Error in gathering data! Possible errors in generating data!')
+                series, trajectory, tsrc = entries[0][:3]
+                if counts['nt'] is None:
+                    counts['nt'] = len(entries[0][3])
+                for entry in entries:
+                    if len(entry[3]) != counts['nt']:
+                        raise ValueError('Some data have inconsistent self.nt! (%s != %s)'
+                                         %(len(entry[3]),counts['nt']))
+                counts['n_rows'] += 1
+                if (series, trajectory) != last_series_traj:
+                    counts['n_unique'] += 1
+                    last_series_traj = (series, trajectory)
+                yield series, trajectory, tsrc, [entry[3] for entry in entries]
+
+        rows = _merged_rows()
+        if drop_incomplete:
+            rows = _complete_trajectories(rows, no_tsrc)
+        _hold_data = None
+        _hold_configId = []
+        last_series = None
+        for series, trajectory, tsrc, idata_list in rows:
+            if _hold_data is None:
+                _hold_data = np.zeros([len(corr_names), _tblock_no, counts['nt']])
+            if series != last_series: # Restart for new series
+                _hold_configId = []
+                last_series = series
+            _hold_data[:,len(_hold_configId),:] = idata_list
+            _hold_configId.append('%s%s_t%s'%(series, str(trajectory).zfill(5),
+                                              str(tsrc).zfill(3)))
+            if len(_hold_configId) == _tblock_no: # Block data once we have enough configurations
+                block_data = []
+                for icorr_data in _hold_data:
+                    # Another safety check
+                    if _tblock_no > 1 and _identical_rows(icorr_data,
+                                                          np.zeros(_tblock_no, dtype=int)):
+                        raise ValueError("Two correlators have same data!")
+                    block_data.append(np.sum(icorr_data, axis=0)/_tblock_no)
+                if len(block_data) > 1:
+                    # sum the raw value for meson and 16 = 16m + 16p
+                    yield '+'.join(_hold_configId), np.sum(np.array(block_data),axis=0)/len(block_data)
+                else:
+                    yield '+'.join(_hold_configId), block_data[0]
+                _hold_configId = []
+
+        n_rows = counts['n_rows']
+        unique_series_traj = counts['n_unique']
+        if (avg_tsrc or drop_incomplete) and unique_series_traj > 0 and \
+           int(math.floor(float(n_rows)/float(unique_series_traj))) != no_tsrc:
+            # Only if the database changed while it was read
+            raise ValueError("The number of time sources per configuration changed while " +
+                             "streaming. Gather the data again.")
+    finally:
+        conn.close()
 
 ########################################################################
 
 class Lattice_Corrlator():
-    def __init__(self, db_name, corr_name, datatag, fit_type, verbose=True):
+    def __init__(self, db_name, corr_name, datatag, fit_type, verbose=True,
+                 rows=None, workers=None, pool_type='thread', tuned=False):
+        """
+        Read in all entries of `corr_name` from `db_name`. If `rows` is given,
+        it should be the list of (series, trajectory, tsrc, dataBZ2, id) tuples
+        returned by `fetch_correlators` for this correlator and no query is
+        made. `workers` and `pool_type` are passed to `decode_blobs` and
+        `tuned` to `fetch_correlators`.
+        """
         self.datatag = datatag
         self.fit_type = fit_type
         self.db_name = db_name
@@ -109,8 +651,10 @@ class Lattice_Corrlator():
         self.avg_tsrc = False
         self.block_no = None
         self.no_tsrc = None # Number of time sources per configuration
-        self.configId = None
-        self.raw_configId = None
+        self.raw_index = None # ConfigIndex of raw_data
+        self.config_index = None # ConfigIndex of output_data
+        self._configId = None # configId and raw_configId strings, built on demand
+        self._raw_configId = None
         self.nconf = None
         self.nt = None
         self.raw_data = None
@@ -118,92 +662,120 @@ class Lattice_Corrlator():
         self._all_series = None
         self.verbose = verbose
 
-        engine = create_engine('sqlite:///'+self.db_name)
-        Session = sessionmaker(bind=engine)
-        session = Session()
-
-        # First query correlator ID
-        corr_entry = session.query(Correlator).filter_by(name=corr_name).all()
-        if len(corr_entry) > 1:
-            raise ValueError("Error in retrieving '%s': more than more entries present in" +
-                             "Correlator Column")
-        else:
-            corr_entry = corr_entry[0]
-
-        if self.fit_type == 'baryon':
-            data_entry = session.query(Datum).filter_by(correlator_id=corr_entry.id,
-                                                        ).order_by(Datum.series,
-                                                                   Datum.trajectory,
-                                                                   Datum.tsrc).all()
-        else:
+        if self.fit_type != 'baryon':
             raise ValueError("Unknow fit type: %s" %self.fit_type)
-        self.raw_configId = ['%s%s_t%s'%(idata.series,
-                                   (str(idata.trajectory)).zfill(5),
-                                   (str(idata.tsrc).zfill(3)))
-                                   for idata in data_entry]
+        if rows is None:
+            rows = fetch_correlators(self.db_name, [corr_name], tuned=tuned)[corr_name]
+        if len(rows) == 0:
+            raise ValueError("No data found for correlator '%s'" %corr_name)
+
+        self.raw_index = config_index([row[0] for row in rows], [row[1] for row in rows],
+                                      [row[2] for row in rows])
+        # Index of every raw_data entry in rows
+        self._raw_rowindx = np.arange(len(rows))
 
         # Query raw data
-        self.raw_data = [np.array(bz2.decompress(idata.dataBZ2).split('\n'),dtype=np.float64)
-             for idata in data_entry]
-        self.nt = len(self.raw_data[0]) # Obtain T
+        with tagged(correlator=corr_name):
+            self._raw_array = decode_blobs([dataBZ2 for series, trajectory, tsrc, dataBZ2, data_id in rows],
+                                           workers=workers, pool_type=pool_type)
+        self.raw_data = list(self._raw_array)
+        self.nt = np.shape(self._raw_array)[1] # Obtain T
 
         # Delete any identical data entries
         # Do not change self.raw_data after this
-        del_indx_list = []
-        
-        for ica, (idataa, iconfiga) in enumerate(zip(self.raw_data, self.raw_configId)):
-            if ica in del_indx_list:
-                continue
-            for icb, (idatab, iconfigb) in enumerate(zip(self.raw_data, self.raw_configId)):
-                if icb <= ica:
-                    continue
-                if iconfiga == iconfigb:
-                    tolerance = 1e-4 # Maximum tolerance for percentage difference
-                    pdiff = np.sum(((idataa - idatab)/idataa))/len(idataa) # average percent difference
-                    maxdiff = np.max((idataa - idatab)/idatab)
-                    if abs(maxdiff) > tolerance or abs(pdiff) > tolerance:
-                        if self.verbose:
-                            print "------------------------------------------------------------------"
-                            print "*****WARNING****** Correlators from two configurations found " +\
-                                    "but NOT identical (%s)!" %iconfiga
-                            print "max percent diff: %s, average percent diff: %s" %(maxdiff, pdiff)
-                            print "This configuration will be all discarded!"
-                            print ica, icb
-                            savconfig = iconfiga
-                            print "------------------------------------------------------------------"
-                        del_indx_list.append(ica)
-                        del_indx_list.append(icb)
-                    else:
-                        # If two correlator entries are identical up to specified tolerance, for the same configuration
-                        # we only keep one of them
-                        if self.verbose:
-                            print '--> WARNING: Identical data present: %s vs %s Only one will be retained.' %(iconfiga, iconfigb)
-                        del_indx_list.append(icb)
-        
-        self.raw_configId = [i for j,i in enumerate(self.raw_configId) if j not in del_indx_list]
-        self.raw_data = [i for j,i in enumerate(self.raw_data) if j not in del_indx_list]
-
-
-        self.raw_unique_configId = set([(i.split('_'))[0] for i in self.raw_configId])
+        with stage('dedup', correlator=corr_name, rows=len(self.raw_index)) as record:
+            self._remove_duplicates()
+            record['discarded'] = record['rows'] - len(self.raw_index)
+        if len(self.raw_index) == 0:
+            raise ValueError("All configurations of correlator '%s' were discarded as " %corr_name +
+                             "conflicting duplicates")
+
+        # Columns of the raw index for blocking; _series holds series codes
+        self._series = self.raw_index.entries['series']
+        self._trajectory = self.raw_index.entries['trajectory']
+        self._tsrc = self.raw_index.entries['tsrc']
+
+        series_traj = np.unique(np.rec.fromarrays([self._series, self._trajectory]))
+        self.raw_unique_configId = set(['%s%s'%(self.raw_index.series_names[series],
+                                                str(trajectory).zfill(5))
+                                        for series, trajectory in series_traj.tolist()])
         # Number of time sources for each correlator
         # Determine no_tsrc AFTER delete duplicate copies or it will be wrong
-        self.no_tsrc = int(math.floor(float(len(self.raw_configId))/float(len(self.raw_unique_configId))))
-
-        # Check if all data have same number of timeslices
-        for idata in self.raw_data:
-            if len(idata) != self.nt:
-                raise ValueError('Some data have inconsistent self.nt! (%s != %s)'
-                                 %(len(idata),self.nt))
+        self.no_tsrc = int(math.floor(float(len(self.raw_index))/float(len(self.raw_unique_configId))))
 
         self.output_data = self.raw_data
-        self.configId = self.raw_configId
+        self.output_array = self._raw_array # output_data as one (nconf, nt) array
+        self.config_index = self.raw_index
         self.nconf = len(self.output_data)
+        self._last_block_rows = np.arange(self.nconf)[:,None]
 
-    def block(self, block_no, avg_tsrc):
+    def _remove_duplicates(self):
+        """
+        Discard duplicate entries of the same configuration in raw_data.
+        If two entries are identical up to the tolerance, only the first one
+        is retained; otherwise all entries of that configuration are discarded.
+
+        Entries are bucketed by their raw_index entry so that only entries
+        within the same bucket are compared. Every later entry of a bucket is
+        discarded once it is compared against the first one, so it suffices
+        to compare the first entry against the rest of the bucket, all at
+        once.
+        """
+        entries = self.raw_index.entries
+        _unique, config_indx, config_count = np.unique(entries, return_inverse=True,
+                                                       return_counts=True)
+        dup_rows = np.flatnonzero(config_count[config_indx] > 1)
+        # Group the rows of every configuration, in row order within a bucket
+        dup_rows = dup_rows[np.argsort(config_indx[dup_rows], kind='mergesort')]
+        bucket_start = np.flatnonzero(np.concatenate([[True], np.diff(config_indx[dup_rows]) != 0]))
+        dup_buckets = sorted([bucket.tolist() for bucket in np.split(dup_rows, bucket_start[1:])
+                              if len(bucket) > 0])
+
+        keep = np.ones(len(entries), dtype=bool)
+        for bucket in dup_buckets:
+            keep[bucket[1:]] = False
+            series, trajectory, tsrc = entries[bucket[0]].tolist()
+            if not _compare_duplicates(self.raw_data[bucket[0]],
+                                       np.array([self.raw_data[icb] for icb in bucket[1:]]),
+                                       _entry_configId(self.raw_index.series_names[series],
+                                                       trajectory, tsrc),
+                                       bucket, verbose=self.verbose):
+                keep[bucket[0]] = False
+
+        self.raw_index = self.raw_index.take(np.flatnonzero(keep)[:,None])
+        self._raw_configId = None
+        self._raw_rowindx = self._raw_rowindx[keep]
+        if not np.all(keep):
+            self._raw_array = self._raw_array[keep]
+            self.raw_data = list(self._raw_array)
+
+    def _block_rows(self, tblock_no, drop_incomplete=False):
+        """
+        Return a (nblock, tblock_no) array of the raw_data row indices of every
+        block. Consecutive rows of the same series are grouped into blocks of
+        tblock_no rows; the trailing rows of every series that do not fill up
+        a whole block are not used. If `drop_incomplete` is True, trajectories
+        with fewer than no_tsrc time sources are masked out first.
+        """
+        rows = np.arange(len(self.raw_index))
+        if drop_incomplete:
+            series_traj = np.rec.fromarrays([self._series, self._trajectory])
+            _unique, traj_indx, traj_count = np.unique(series_traj, return_inverse=True,
+                                                       return_counts=True)
+            rows = rows[traj_count[traj_indx] >= self.no_tsrc]
+        if len(rows) == 0:
+            return np.zeros([0, tblock_no], dtype=int)
+        block_start = _block_starts(self._series[rows], tblock_no)
+        return rows[block_start[:,None] + np.arange(tblock_no)]
+
+    def block(self, block_no, avg_tsrc, drop_incomplete=False):
         """
         Perform blocking to output data for both trajectories and time source.
         This will automatically perform tsrcavg. It will overwrite the
         previous blocking results if called.
+        If `drop_incomplete` is True, trajectories that do not have all
+        no_tsrc time sources are skipped instead of being blocked with their
+        neighbours.
         """
         self.block_no = block_no
         if avg_tsrc:
@@ -212,70 +784,204 @@ class Lattice_Corrlator():
         else:
             self.avg_tsrc = False
             _tblock_no = self.block_no
-        _temp_out_data = []
-        _temp_out_configId = []
-        counter = 0
-        for idata,iconfigid in zip(self.raw_data, self.raw_configId):
-            current_series = iconfigid[0] # First character in the configId string
-            current_series_traj = (iconfigid.split('_t'))[0]
-            current_tsrc = int((iconfigid.split('_t'))[1])
-
-            if counter%_tblock_no == 0: # Initilization for every block
-                last_series = iconfigid[0]
-                last_series_traj = None
-                last_tsrc = None
-                _hold_data = np.zeros([_tblock_no, self.nt])
-                _hold_configId = []
 
-            # Skip particular trajectory if we cannot find enough tsrc
-            if ((counter%self.no_tsrc != self.no_tsrc-1)
-                and (current_series_traj != last_series_traj)
-                and (last_series_traj) != None 
-                and (counter%self.no_tsrc != 0)):
-                # Revert counter to erase this particular trajectory
-                for revert_indx, _tmp in enumerate(_hold_configId):
-                    if _tmp.startswith(last_series_traj):
-                        break
-                _hold_configId = _hold_configId[:revert_indx]
-                counter -= revert_indx
-
-            if current_series != last_series: # Restart for new series
-                _hold_data = np.zeros([_tblock_no, self.nt]) # Dump the unused configId
-                _hold_configId = []
-                counter = 0
-
-            if current_tsrc == last_series and current_series_traj == current_series_traj:
-                raise ValueError("Trying to block identical correlator!")
-
-            _hold_data[counter%_tblock_no,:] = idata
-            _hold_configId.append(iconfigid)
-
-            if counter%_tblock_no == _tblock_no-1: # Block data once we have enough configurations
-                for dk in range(np.shape(_hold_data)[0]):
-                    for uk in range(np.shape(_hold_data)[0]):
-                        if dk != uk:
-                            if np.array_equal(_hold_data[dk,:],_hold_data[uk,:]):
-                                # Another safety check
-                                raise ValueError("Two correlators have same data!")
-                if len(_hold_configId) == 0:
-                    raise ValueError("Nothing to block? Code error?")
-                _temp_out_data.append(np.sum(_hold_data, axis=0)/(np.shape(_hold_data)[0]))
-                _temp_out_configId.append('+'.join(_hold_configId))
-
-                # Zero out after averaging
-                _hold_data = np.zeros([_tblock_no, self.nt])
-                _hold_configId = []
+        with stage('block', correlator=self.corr_name, rows=len(self.raw_index),
+                   rows_per_block=_tblock_no) as record:
+            block_rows = self._block_rows(_tblock_no, drop_incomplete=drop_incomplete)
+            _hold_data = self._raw_array[block_rows] # (nblock, _tblock_no, nt)
+
+            if _tblock_no > 1 and len(block_rows) > 0:
+                # Another safety check
+                if _identical_rows(_hold_data.reshape(-1, self.nt),
+                                   np.repeat(np.arange(len(block_rows)), _tblock_no)):
+                    raise ValueError("Two correlators have same data!")
+
+            self._last_block_rows = block_rows
+            self.output_array = np.sum(_hold_data, axis=1)/_tblock_no
+            self.output_data = list(self.output_array)
+            self.config_index = self.raw_index.take(block_rows)
+            self._configId = None
+            self.nconf = len(self.output_data)
+            record['blocks'] = self.nconf
+
+    def unit_data(self, avg_tsrc, drop_incomplete=False):
+        """
+        Return the data blocked with block_no = 1 without changing the last
+        blocking: the ConfigIndex, a (nunit, nt) array and the series code of
+        every unit. A unit is one entry, or with `avg_tsrc` the average over
+        the no_tsrc time sources of a configuration.
+        """
+        unit_rows = self.no_tsrc if avg_tsrc else 1
+        block_rows = self._block_rows(unit_rows, drop_incomplete=drop_incomplete)
+        units = np.sum(self._raw_array[block_rows], axis=1)/unit_rows
+        return self.raw_index.take(block_rows), units, self._series[block_rows[:,0]]
 
-            # Ready for next iteration
-            last_series = current_series
-            last_seriest_traj = current_series_traj
-            last_tsrc = current_tsrc
-            counter += 1
+    def blocking_sweep(self, block_sizes, avg_tsrc, drop_incomplete=False):
+        """
+        Return the blocked means, their errors and the integrated
+        autocorrelation time for all `block_sizes` at once (see
+        blocking_sweep) without changing the last blocking. The block sizes
+        count configurations with `avg_tsrc` and entries without, as
+        block_no of block.
+        """
+        with stage('blocking_sweep', correlator=self.corr_name, rows=len(self.raw_index),
+                   block_sizes=len(block_sizes)):
+            unit_index, units, series = self.unit_data(avg_tsrc, drop_incomplete=drop_incomplete)
+            return blocking_sweep(units, series, block_sizes)
 
-        self.output_data = _temp_out_data
-        self.configId = _temp_out_configId
-        self.nconf = len(self.output_data)
+    def unblocked_rows(self):
+        """
+        Return the indices of the raw_data entries that are not part of any
+        block of the last blocking. Unless drop_incomplete was used, these are
+        the trailing entries of every series that do not fill up a whole
+        block.
+        """
+        used = np.zeros(len(self.raw_index), dtype=bool)
+        used[self._last_block_rows.flatten()] = True
+        return np.flatnonzero(~used)
+
+    @property
+    def configId(self):
+        """
+        Legacy configId strings of output_data, built from config_index.
+        """
+        if self._configId is None:
+            self._configId = self.config_index.configIds()
+        return self._configId
+
+    @property
+    def raw_configId(self):
+        """
+        Legacy configId strings of raw_data, built from raw_index.
+        """
+        if self._raw_configId is None:
+            self._raw_configId = self.raw_index.configIds()
+        return self._raw_configId
 
     def get_data(self):
         return self.output_data
 
+
+def _entry_size(npt):
+    """
+    Approximate memory use of the raw data of a Lattice_Corrlator in bytes.
+    """
+    return npt._raw_array.nbytes + npt.raw_index.entries.nbytes + npt.raw_index.offsets.nbytes
+
+class CorrelatorCache():
+    """
+    Least recently used cache of deduplicated Lattice_Corrlator objects, so
+    that a correlator can be blocked in several ways while the database is
+    queried and decoded only once. Entries are keyed by the absolute path of
+    the database and the correlator name, and are only used while the
+    database has the fingerprint it had when they were read. Least recently
+    used entries are dropped once the raw data of all entries exceeds
+    `budget` bytes; a budget of 0 keeps nothing. The cache can be used from
+    several threads, but blocking changes the state of the returned
+    objects, so a caller that shares them between threads has to serialize
+    its calls to block.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = collections.OrderedDict() # key -> (db_fp, npt, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def cached(self, db_name, db_fp, corr_name):
+        """
+        Return True if `corr_name` of `db_name` with fingerprint `db_fp` is
+        cached.
+        """
+        with self.lock:
+            entry = self.entries.get((os.path.abspath(db_name), corr_name))
+            return entry is not None and entry[0] == db_fp
+
+    def get(self, db_name, corr_names, db_fp=None, rows_dict=None, tuned=False,
+            workers=None, pool_type='thread', verbose=True):
+        """
+        Return {corr_name: Lattice_Corrlator} for `corr_names` of `db_name`.
+        Correlators that are not cached are built from `rows_dict` (see
+        fetch_correlators) where it has them, and the rest are fetched with
+        one query. `db_fp` is the db_fingerprint of the database, which is
+        computed if not given. The other arguments are passed to
+        fetch_correlators and Lattice_Corrlator.
+        """
+        if db_fp is None:
+            db_fp = db_fingerprint(db_name)
+        db_path = os.path.abspath(db_name)
+        npt_dict = dict()
+        with self.lock:
+            missing = []
+            for corr_name in corr_names:
+                entry = self.entries.pop((db_path, corr_name), None)
+                if entry is not None and entry[0] == db_fp:
+                    # Move to the most recently used end
+                    self.entries[(db_path, corr_name)] = entry
+                    npt_dict[corr_name] = entry[1]
+                else:
+                    if entry is not None:
+                        self.size -= entry[2]
+                    missing.append(corr_name)
+            self.hits += len(corr_names) - len(missing)
+            self.misses += len(missing)
+            if rows_dict is None:
+                rows_dict = dict()
+            to_fetch = [corr_name for corr_name in missing if corr_name not in rows_dict]
+            if len(to_fetch) > 0:
+                rows_dict = dict(rows_dict)
+                rows_dict.update(fetch_correlators(db_name, to_fetch, tuned=tuned))
+            for corr_name in missing:
+                npt = Lattice_Corrlator(db_name, corr_name, None, 'baryon', verbose=verbose,
+                                        rows=rows_dict[corr_name], workers=workers,
+                                        pool_type=pool_type)
+                size = _entry_size(npt)
+                self.entries[(db_path, corr_name)] = (db_fp, npt, size)
+                self.size += size
+                npt_dict[corr_name] = npt
+            self.evict()
+        return npt_dict
+
+    def evict(self):
+        """
+        Drop least recently used entries until the cache fits its budget.
+        """
+        with self.lock:
+            while self.size > self.budget and len(self.entries) > 0:
+                key, (db_fp, npt, size) = self.entries.popitem(last=False)
+                self.size -= size
+
+    def discard(self, db_name, corr_name):
+        """
+        Drop the entry of `corr_name` of `db_name` if it is cached.
+        """
+        with self.lock:
+            entry = self.entries.pop((os.path.abspath(db_name), corr_name), None)
+            if entry is not None:
+                self.size -= entry[2]
+
+    def clear(self):
+        """
+        Drop all entries.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'size': self.size,
+                    'budget': self.budget, 'hits': self.hits, 'misses': self.misses}
+
+_raw_cache = CorrelatorCache(0)
+
+def raw_cache(budget=None):
+    """
+    Return the CorrelatorCache of this process, setting its budget in bytes
+    first if `budget` is given. The budget is 0 until it is set.
+    """
+    if budget is not None:
+        _raw_cache.budget = float(budget)
+        _raw_cache.evict()
+    return _raw_cache
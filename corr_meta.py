@@ -0,0 +1,289 @@
+"""
+Light-weight part of the correlator database layer: reading input files,
+data tags, configuration indices and database fingerprints. It only needs
+numpy and the standard library, so that cached data sets are found and
+loaded without importing SQLAlchemy and the ORM schema of DB.py, which
+corr_db loads when the database is read.
+"""
+import os, re, hashlib, json, datetime
+import sqlite3
+import numpy as np
+
+########################################################################
+"""
+From utilies.py
+"""
+
+def readin_stream(input_stream):
+    """
+    Utility to either read in yaml file or dictionary. Return dictionary in both
+    cases. The yaml file can contain multiple documents, and if this is the case,
+    it will return a list of all dictionary for each document.
+    """
+    if isinstance(input_stream, str):
+        if input_stream.endswith('.yaml'):
+            import yaml
+            try:
+                stream = file(input_stream, 'r')
+                param_dict = yaml.load(stream)
+                default_dict = param_dict #based default param
+            except:
+                try:
+                    stream = file(input_stream, 'r')
+                    param_dict = yaml.load_all(stream)
+                    default_dict = [i for i in param_dict] # List of dictionary of each document
+                except:
+                    raise ValueError('Cannot open file %s '%input_stream)
+        else:
+            raise ValueError('Unknow suffix for file %s'%input_stream)
+    else:
+        default_dict = input_stream
+    return default_dict
+
+def generate_tag_baryon(src_irrep, sink_irrep, src_class, sink_class, mom, mass,
+                 ensemble):
+    """
+    Generate data tags for particular correlator keys to identify them in
+    corrfitter. The goal is that we want the tags it generated only has
+    information about the irreps we use for src/sink, the classes of those
+    corresponding src/sink operators, the momentum for each quark, mass for
+    each quark, and the ensemble we used.
+
+    Possible list of src/sink_irrep:
+        '8p': 8 irrep (fundamental)
+        '8m': 8 prime irrep
+        '16p'&'16m': 16 irrep (p/m represents plus/minus eigenvalues of R12)
+                     This will not work with gather_data routine
+        '16': 16 irrep. This will work with gather_data routine
+
+    This is used for both tagging the data in corrfitter and the file names
+    for the pickle files.
+    """
+
+    #assume momentum are same for all three if string provided
+    if isinstance(mom, str):
+        if len(mom) != 3:
+            raise
+        mom = (mom,mom,mom)
+
+    if src_irrep != sink_irrep:
+        #I should only give one irrep choice..
+        raise ValueError('source irrep must be identical to sink irrep!')
+
+    group_construct = '%s_s_%s_%s_s_%s_'%(
+            src_irrep, src_class, sink_irrep, sink_class)
+    mom_construct = 'p%s_p%s_p%s_'%(mom[0], mom[1], mom[2])
+    mass_construct = 'm%s_m%s_m%s_'%(mass,mass,mass) #same masses for all
+
+    return group_construct + mom_construct + mass_construct + ensemble
+
+def parse_tag_baryon(datatag):
+    """
+    Inverse of generate_tag. Given datatag, return library with keys of
+        (src_irrep, sink_irrep, src_class, sink_class, mom, mass, ensemble)
+    """
+    datatag_split = datatag.split('_')
+    src_irrep  = datatag_split[0]
+    src_class  = datatag_split[2]
+    sink_irrep = datatag_split[3]
+    sink_class = datatag_split[5]
+    mom0       = (datatag_split[6])[1:]
+    mom1       = (datatag_split[7])[1:]
+    mom2       = (datatag_split[8])[1:]
+    mom        = (mom0,mom1,mom2)
+    mass       = float((datatag_split[9])[1:])
+    ensemble   = datatag_split[12]
+
+    data_dict = dict()
+    data_dict['src_irrep']  = src_irrep
+    data_dict['sink_irrep'] = sink_irrep
+    data_dict['src_class']  = src_class
+    data_dict['sink_class'] = sink_class
+    data_dict['mom']        = mom
+    data_dict['mass']       = mass
+    data_dict['ensemble']   = ensemble
+    return data_dict
+
+def _parse_configId(configId_list):
+    """
+    Parse a list of unblocked configId strings such as 'a00110_t036' into
+    arrays of series, trajectory and tsrc.
+    """
+    series = []
+    trajectory = []
+    tsrc = []
+    for iconfigid in configId_list:
+        series_traj, itsrc = iconfigid.split('_t')
+        iseries = series_traj.rstrip('0123456789')
+        series.append(iseries)
+        trajectory.append(int(series_traj[len(iseries):]))
+        tsrc.append(int(itsrc))
+    return (np.array(series, dtype=str), np.array(trajectory, dtype=int),
+            np.array(tsrc, dtype=int))
+
+# Series code, trajectory and tsrc of a raw entry
+CONFIG_DTYPE = np.dtype([('series', '<u2'), ('trajectory', '<i4'), ('tsrc', '<i4')])
+
+def _entry_configId(series, trajectory, tsrc):
+    """
+    Legacy configId string of one raw entry, e.g. 'a00110_t036'.
+    """
+    return '%s%s_t%s'%(series, str(trajectory).zfill(5), str(tsrc).zfill(3))
+
+class ConfigIndex():
+    """
+    Compact index of the configurations of (blocked) correlator data. The
+    raw entries are kept in `entries`, a structured array of the series
+    code, trajectory and tsrc of every entry (CONFIG_DTYPE), in block
+    order; `series_names` holds the series name of every code, and block k
+    consists of entries[offsets[k]:offsets[k+1]]. The legacy configId
+    strings, e.g. 'a00110_t036+a00115_t038' for a block of two entries, are
+    built on demand by configIds.
+    """
+    def __init__(self, series_names, entries, offsets=None):
+        self.series_names = [str(name) for name in series_names]
+        self.entries = entries
+        if offsets is None:
+            offsets = np.arange(len(entries) + 1)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __eq__(self, other):
+        if not isinstance(other, ConfigIndex):
+            return False
+        if not np.array_equal(self.offsets, other.offsets):
+            return False
+        if self.series_names == other.series_names:
+            return np.array_equal(self.entries, other.entries)
+        return np.array_equal(self.series(), other.series()) and \
+            np.array_equal(self.entries['trajectory'], other.entries['trajectory']) and \
+            np.array_equal(self.entries['tsrc'], other.entries['tsrc'])
+
+    def __ne__(self, other):
+        return not self == other
+
+    def series(self):
+        """
+        Return the series name of every entry.
+        """
+        return np.array(self.series_names, dtype=str)[self.entries['series']]
+
+    def take(self, block_rows):
+        """
+        Return the index of the blocks of entries given by the rows of the
+        (nblock, block size) array `block_rows` of entry indices of this
+        unblocked index.
+        """
+        block_rows = np.asarray(block_rows, dtype=int)
+        block_size = np.shape(block_rows)[1]
+        return ConfigIndex(self.series_names, self.entries[block_rows.reshape(-1)],
+                           np.arange(len(block_rows) + 1)*block_size)
+
+    def configIds(self):
+        """
+        Return the legacy configId string of every block.
+        """
+        strings = [_entry_configId(self.series_names[series], trajectory, tsrc)
+                   for series, trajectory, tsrc in self.entries.tolist()]
+        if len(self.entries) == len(self):
+            return strings
+        return ['+'.join(strings[start:end])
+                for start, end in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def to_json(self):
+        """
+        Return the index as a dictionary of lists (see config_index_from_json).
+        """
+        return {'series_names': self.series_names,
+                'series': self.entries['series'].tolist(),
+                'trajectory': self.entries['trajectory'].tolist(),
+                'tsrc': self.entries['tsrc'].tolist(),
+                'offsets': self.offsets.tolist()}
+
+def config_index(series, trajectory, tsrc, offsets=None):
+    """
+    Return the ConfigIndex of entries with the given series names,
+    trajectories and tsrc, blocked by `offsets` (default: unblocked).
+    """
+    series_names, codes = np.unique(np.asarray(series, dtype=str), return_inverse=True)
+    entries = np.empty(len(codes), dtype=CONFIG_DTYPE)
+    entries['series'] = codes
+    entries['trajectory'] = trajectory
+    entries['tsrc'] = tsrc
+    return ConfigIndex(series_names, entries, offsets)
+
+def parse_config_index(configId_list):
+    """
+    Parse a list of legacy configId strings, with the entries of a block
+    joined by '+', into a ConfigIndex.
+    """
+    entry_list = []
+    offsets = [0]
+    for iconfigid in configId_list:
+        ientries = iconfigid.split('+')
+        entry_list += ientries
+        offsets.append(offsets[-1] + len(ientries))
+    series, trajectory, tsrc = _parse_configId(entry_list)
+    return config_index(series, trajectory, tsrc, offsets)
+
+def config_index_from_json(index_dict):
+    """
+    Inverse of ConfigIndex.to_json.
+    """
+    entries = np.empty(len(index_dict['series']), dtype=CONFIG_DTYPE)
+    for field in ['series', 'trajectory', 'tsrc']:
+        entries[field] = index_dict[field]
+    return ConfigIndex(index_dict['series_names'], entries, index_dict['offsets'])
+
+# Columns of the fingerprint: (table, column, aggregate)
+_FINGERPRINT_COLUMNS = [('modify_times', 'time', 'max'),
+                        ('correlator_files', 'id', 'max'),
+                        ('correlator_files', 'id', 'count'),
+                        ('correlators', 'id', 'max'),
+                        ('data', 'id', 'max')]
+
+_DATETIME_RE = re.compile(r'(\d+)-(\d+)-(\d+)(?:[ T](\d+):(\d+):(\d+)(?:\.(\d+))?)?')
+
+def _datetime_str(value):
+    """
+    Format a DATETIME column value as the datetime object SQLAlchemy
+    returns for it, so that the fingerprints of both are the same.
+    """
+    if value is None:
+        return str(value)
+    fields = _DATETIME_RE.match(value).groups()
+    microsecond = int((fields[6] or '0').ljust(6, '0')[:6])
+    return str(datetime.datetime(*([int(field or 0) for field in fields[:6]] + [microsecond])))
+
+def db_fingerprint(db_name):
+    """
+    Return a string that changes whenever data is added to the database
+    `db_name`. It is built from the last modification time in the
+    modify_times table, the number and largest id of correlator_files entries
+    and the largest ids of the correlators and data tables. These are cheap
+    primary key lookups, so no data is read. Return None if `db_name` does
+    not exist.
+
+    The tables are read with the sqlite3 module, so a cache lookup does not
+    load the database layer.
+    """
+    if not os.path.isfile(db_name):
+        return None
+    conn = sqlite3.connect(db_name)
+    try:
+        conn.execute('PRAGMA query_only = ON')
+        tables = set(name for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'"))
+        fingerprint = dict()
+        for table, column, function in _FINGERPRINT_COLUMNS:
+            # Older databases may not have all tables
+            if table in tables:
+                value = conn.execute('SELECT %s(%s) FROM %s' %(function, column, table)).fetchone()[0]
+                if column == 'time':
+                    value = _datetime_str(value)
+                fingerprint['%s.%s.%s'%(table, column, function)] = str(value)
+    finally:
+        conn.close()
+    return hashlib.md5(json.dumps(fingerprint, sort_keys=True)).hexdigest()
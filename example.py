@@ -1,4 +1,3 @@
-from corr_db import *
 from gather_data import *
 yamlfn = "./gather_012fm.yaml"
 input_dict = readin_stream(yamlfn) 
@@ -0,0 +1,166 @@
+"""
+Client of the gather daemon (see gather_daemon.py). `gather` sends the
+input dictionary of gather_dataset to the daemon over its Unix socket and
+returns the same (data_dict, meta_dict). If no daemon is running, it falls
+back to running gather_dataset in this process. Only the standard library
+is imported unless the fallback is needed, so a short-lived fitting job
+that is served by the daemon never loads SQLAlchemy or opens the database.
+
+Messages are pickles preceded by their length, so both ends only talk to
+processes of the same user: the default socket is in a directory that only
+the user can access, the client refuses sockets of other users and checks
+the user of the process that answers, and the daemon checks the user of
+every client. Requests time out instead of waiting for a stuck daemon
+forever.
+"""
+import os
+import sys
+import stat
+import errno
+import socket
+import struct
+import cPickle as pickle
+
+SOCKET_NAME = 'gather.sock'
+# Seconds to wait for the daemon to answer a request
+DEFAULT_TIMEOUT = 3600.
+# SO_PEERCRED is not exported by the socket module of Python 2; 17 is its
+# value on Linux
+_SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+def socket_dir():
+    """
+    Return the directory of the default socket, $XDG_RUNTIME_DIR/axialdb or
+    else ~/.axialdb, and create it with access for this user only. Raise
+    ValueError if it is not a directory of this user.
+    """
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        directory = os.path.join(os.environ['XDG_RUNTIME_DIR'], 'axialdb')
+    else:
+        directory = os.path.join(os.path.expanduser('~'), '.axialdb')
+    try:
+        os.makedirs(directory, 0700)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise ValueError('%s is not a directory of this user' %directory)
+    if st.st_mode & 0077:
+        os.chmod(directory, 0700)
+    return directory
+
+def socket_path(input_dict=None):
+    """
+    Return the socket of the daemon: the 'daemon_socket' key of
+    `input_dict`, else $AXIALDB_GATHER_SOCKET, else SOCKET_NAME in
+    socket_dir().
+    """
+    if input_dict is not None and input_dict.get('daemon_socket') is not None:
+        return input_dict['daemon_socket']
+    if os.environ.get('AXIALDB_GATHER_SOCKET'):
+        return os.environ['AXIALDB_GATHER_SOCKET']
+    return os.path.join(socket_dir(), SOCKET_NAME)
+
+def check_owner(path):
+    """
+    Raise socket.error if there is no socket `path` or if it belongs to
+    another user, who could otherwise answer in place of the daemon.
+    """
+    try:
+        st = os.stat(path)
+    except OSError as err:
+        raise socket.error(err.errno, '%s: %s' %(err.strerror, path))
+    if st.st_uid != os.getuid():
+        raise socket.error(errno.EACCES, 'The socket %s belongs to another user' %path)
+
+def peer_uid(sock):
+    """
+    Return the user id of the process at the other end of the Unix socket
+    `sock`, or None if the platform cannot tell. The credentials are only
+    read on Linux; elsewhere the socket file, which belongs to the user and
+    has mode 0600, keeps other users out.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    pid, uid, gid = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, _SO_PEERCRED,
+                                                        struct.calcsize('3i')))
+    return uid
+
+def send_message(sock, message):
+    """
+    Send one message over the socket `sock`.
+    """
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(struct.pack('!Q', len(data)) + data)
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1<<22))
+        if chunk == '':
+            raise EOFError('Connection to the gather daemon closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def recv_message(sock):
+    """
+    Receive one message from the socket `sock`.
+    """
+    size, = struct.unpack('!Q', _recv_exactly(sock, 8))
+    return pickle.loads(_recv_exactly(sock, size))
+
+def request(message, path=None, timeout=DEFAULT_TIMEOUT):
+    """
+    Send `message` to the daemon listening on `path` and return its
+    response. Raise socket.error if no daemon of this user is listening,
+    and socket.timeout if it does not answer within `timeout` seconds.
+    """
+    if path is None:
+        path = socket_path()
+    check_owner(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        if peer_uid(sock) not in [None, os.getuid()]:
+            raise socket.error(errno.EACCES, 'The daemon on %s runs as another user' %path)
+        send_message(sock, message)
+        response = recv_message(sock)
+    finally:
+        sock.close()
+    if response.get('error') is not None:
+        raise ValueError('Error in the gather daemon:\n%s' %response['error'])
+    return response
+
+def daemon_running(path=None, timeout=10.):
+    """
+    Return True if a daemon of this user answers on `path` within `timeout`
+    seconds.
+    """
+    try:
+        request({'op': 'stats'}, path, timeout=timeout)
+    except socket.error:
+        return False
+    return True
+
+def gather(input_dict, path=None, fallback=True):
+    """
+    Gather the data set of `input_dict` like gather_dataset, from the daemon
+    listening on `path` (default: socket_path(input_dict)). If no daemon is
+    running and `fallback` is set, run gather_dataset in this process.
+    The request times out after the 'daemon_timeout' key of `input_dict`
+    (default: DEFAULT_TIMEOUT) seconds. Return (data_dict, meta_dict).
+    """
+    if path is None:
+        path = socket_path(input_dict)
+    try:
+        response = request({'op': 'gather', 'input_dict': input_dict}, path,
+                           timeout=float(input_dict.get('daemon_timeout', DEFAULT_TIMEOUT)))
+    except socket.error as err:
+        if not fallback or err.errno not in [errno.ENOENT, errno.ECONNREFUSED]:
+            raise
+        from gather_data import gather_dataset
+        return gather_dataset(input_dict)
+    return response['data_dict'], response['meta_dict']
@@ -0,0 +1,154 @@
+"""
+Long-lived gather daemon. It keeps the decoded and deduplicated entries of
+every correlator it has read (a Lattice_Corrlator) in memory, in a least
+recently used cache bounded by a memory budget and keyed by database and
+correlator name, and answers gather_dataset requests of gather_client.py
+over a Unix socket with any 'blocking' and 'avg_tsrc'. A correlator is read
+again when the fingerprint of its database changes. The data is blocked
+and averaged exactly as in gather_data, but no cache files are written.
+
+usage: python gather_daemon.py [--socket PATH] [--memory-budget BYTES]
+"""
+import os
+import sys
+import socket
+import argparse
+import threading
+import traceback
+import SocketServer
+from corr_db import *
+from gather_data import _generate_correlator_keys_baryon, _blocking_number, \
+    _combine_correlators, _datatag_list, _meta_output
+from gather_client import send_message, recv_message, socket_path, daemon_running, \
+    peer_uid
+from metrics import stage, tagged
+
+class GatherDaemon():
+    """
+    Serve gather requests from a CorrelatorCache. Requests are handled in
+    threads, but the cache and the blocking are guarded by one lock, since
+    blocking changes the state of the cached Lattice_Corrlator objects.
+    """
+    def __init__(self, memory_budget):
+        self.cache = CorrelatorCache(memory_budget)
+        self.lock = threading.Lock()
+
+    def gather(self, input_dict):
+        """
+        Return (data_dict, meta_dict) as gather_dataset would for `input_dict`.
+        """
+        datatag_list = _datatag_list(input_dict)
+        key_dict = dict((datatag, _generate_correlator_keys_baryon(datatag, input_dict))
+                        for datatag in datatag_list)
+        corr_names = []
+        for datatag in datatag_list:
+            corr_names += [name for name in key_dict[datatag] if name not in corr_names]
+        blockno = _blocking_number(input_dict)
+        data_dict = dict()
+        meta_dict = dict()
+        with tagged(ensemble=input_dict['ensemble'], db_name=input_dict['db_name']):
+            with self.lock:
+                db_fp = db_fingerprint(input_dict['db_name'])
+                if db_fp is None:
+                    raise ValueError('Cannot find database %s' %input_dict['db_name'])
+                with stage('daemon_lookup', correlators=len(corr_names)) as record:
+                    hits = self.cache.hits
+                    npt_dict = self.cache.get(input_dict['db_name'], corr_names, db_fp,
+                                              tuned=input_dict.get('tune_db', False),
+                                              workers=input_dict.get('decode_workers'),
+                                              pool_type=input_dict.get('decode_pool', 'thread'))
+                    record['hits'] = self.cache.hits - hits
+                for datatag in datatag_list:
+                    with tagged(datatag=datatag):
+                        block_list = []
+                        for corr_name in key_dict[datatag]:
+                            npt = npt_dict[corr_name]
+                            npt.block(block_no=blockno, avg_tsrc=input_dict['avg_tsrc'])
+                            block_list.append((npt.config_index, npt.output_data))
+                        dlist, meta_info, tot = _combine_correlators(block_list,
+                                                                     input_dict['op_irrep'])
+                    if tot == 0:
+                        raise ValueError('No configurations found!')
+                    if len(meta_info) != len(list(dlist)):
+                        raise ValueError("Inconsistent length between meta_info and dlist!")
+                    data_dict[datatag] = list(dlist)
+                    meta_dict[datatag] = _meta_output(meta_info,
+                                                      input_dict.get('config_index', False))
+        return data_dict, meta_dict
+
+    def handle(self, message):
+        """
+        Answer one request message.
+        """
+        if message['op'] == 'gather':
+            data_dict, meta_dict = self.gather(message['input_dict'])
+            return {'data_dict': data_dict, 'meta_dict': meta_dict}
+        elif message['op'] == 'stats':
+            with self.lock:
+                return {'stats': self.cache.stats()}
+        elif message['op'] == 'clear':
+            with self.lock:
+                self.cache.clear()
+            return {}
+        raise ValueError('Unknown request %s' %message['op'])
+
+class _RequestHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        if peer_uid(self.request) not in [None, os.getuid()]:
+            return # requests are unpickled, so only the owner is served
+        try:
+            message = recv_message(self.request)
+        except EOFError:
+            return
+        try:
+            if message['op'] == 'stop':
+                response = {}
+                threading.Thread(target=self.server.shutdown).start()
+            else:
+                response = self.server.gather_daemon.handle(message)
+        except Exception:
+            response = {'error': traceback.format_exc()}
+        send_message(self.request, response)
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+    def server_bind(self):
+        # Only the owner may connect, since requests are unpickled
+        umask = os.umask(0177)
+        try:
+            SocketServer.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+
+def serve(path=None, memory_budget=8*2**30):
+    """
+    Run the daemon on the Unix socket `path` (default: socket_path()) until
+    a 'stop' request arrives.
+    """
+    if path is None:
+        path = socket_path()
+    if os.path.exists(path):
+        if os.stat(path).st_uid != os.getuid():
+            raise ValueError('%s belongs to another user' %path)
+        if daemon_running(path):
+            raise ValueError('A gather daemon is already listening on %s' %path)
+        os.remove(path) # left over from a daemon that did not stop cleanly
+    server = _Server(path, _RequestHandler)
+    server.gather_daemon = GatherDaemon(memory_budget)
+    print 'Gather daemon listening on %s' %path
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+        close_engines()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--socket', default=None, help='Unix socket (default: %s)' %socket_path())
+    parser.add_argument('--memory-budget', type=float, default=8*2**30,
+                        help='bytes of decoded correlators kept in memory')
+    args = parser.parse_args()
+    serve(args.socket, args.memory_budget)
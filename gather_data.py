@@ -1,9 +1,24 @@
 import time
-import yaml
 import os
 import pickle
+import json
+import base64
+import math
+import traceback
+import contextlib
+import StringIO
+import collections
 import numpy as np
-from corr_db import *
+# The database layer (corr_db, SQLAlchemy and the ORM schema of DB.py) is
+# only imported where correlators are read, so that cache hits need numpy
+# only. `from gather_data import *` therefore no longer provides the names of
+# corr_db (Lattice_Corrlator, get_engine, ...); import them from corr_db.
+from corr_meta import *
+from corr_meta import _parse_configId
+from cache_manifest import *
+from metrics import *
+from resample import jackknife, bootstrap, bootstrap_indices
+from shared_data import publish as publish_dataset
 import sys
 
 #ordered direction of corner wall source to be used later by other modules
@@ -76,161 +91,1198 @@ def main():
 
     # Read in param files
     default_dict = readin_stream(sys.argv[1])
-    gather_dataset(default_dict)
+    if isinstance(default_dict, list):
+        gather_batch(default_dict)
+    else:
+        gather_dataset(default_dict)
+
+def _cache_names(datatag, input_dict, out_format="gpl"):
+    """
+    Return the data and meta cache file names for datatag.
+    """
+    #save name for the dataset
+    #TODO: add this data back to database to have a more coherent data
+    #management.
+    output_dir = input_dict['data_dir']
+    save_name = output_dir + '/' + 'raw_' + datatag + '_' + 'baryon' +\
+                "_tsrcavg" + str(int(input_dict['avg_tsrc'])) + "_blocking" + str(input_dict['blocking']) +\
+                ".%s"%out_format #use datatag as file name
+    meta_save_name = output_dir + '/' + 'meta_' + datatag + '_' + 'baryon' +\
+                     "_tsrcavg" + str(int(input_dict['avg_tsrc'])) + "_blocking" + str(input_dict['blocking']) +\
+                     '.%s'%_meta_suffix(out_format)
+    return save_name, meta_save_name
+
+def _meta_suffix(out_format):
+    """
+    File suffix of the meta cache file. The npy format keeps its meta
+    information in a json sidecar.
+    """
+    if out_format == "npy":
+        return "json"
+    return out_format
+
+def _need_query(datatag, input_dict, out_format="gpl", db_fp=None, manifest=None):
+    """
+    Return True if the data of datatag has to be queried from the database
+    instead of being read from the cache files. This is the case if
+    overwrite is requested, if the cache files are missing, or if the cache
+    manifest shows that they were built from a different state of the
+    database (`db_fp`, see `db_fingerprint`) or by a different query.
+    """
+    save_name, meta_save_name = _cache_names(datatag, input_dict, out_format)
+    if input_dict.get('overwrite', False) is True:
+        return True
+    if os.path.isfile(save_name) is False or os.path.isfile(meta_save_name) is False:
+        return True
+    if db_fp is None:
+        db_fp = db_fingerprint(input_dict['db_name'])
+        if db_fp is None:
+            print 'WARNING: Cannot find database %s, using existing cache file %s' %(
+                input_dict['db_name'], save_name)
+            return False
+    if manifest is None:
+        manifest = load_manifest(input_dict['data_dir'])
+    query_fp = query_fingerprint(datatag, _generate_correlator_keys_baryon(datatag, input_dict),
+                                 input_dict, out_format)
+    return not is_fresh(manifest, save_name, db_fp, query_fp)
+
+def _state_name(save_name):
+    """
+    Name of the file that keeps the state for incremental refreshes of the
+    cache file `save_name`.
+    """
+    return os.path.join(os.path.dirname(save_name),
+                        'state_' + os.path.basename(save_name)[len('raw_'):] + '.json')
+
+def _can_refresh(datatag, input_dict, out_format="gpl", manifest=None):
+    """
+    Return True if the cache of datatag can be refreshed incrementally, i.e.
+    incremental mode is requested, no overwrite is requested and the cache
+    files and their incremental state exist for the same query.
+    """
+    if not input_dict.get('incremental', False) or input_dict.get('overwrite', False) is True:
+        return False
+    save_name, meta_save_name = _cache_names(datatag, input_dict, out_format)
+    for file_name in [save_name, meta_save_name, _state_name(save_name)]:
+        if not os.path.isfile(file_name):
+            return False
+    if manifest is None:
+        manifest = load_manifest(input_dict['data_dir'])
+    entry = manifest.get(os.path.basename(save_name))
+    query_fp = query_fingerprint(datatag, _generate_correlator_keys_baryon(datatag, input_dict),
+                                 input_dict, out_format)
+    return entry is not None and entry['query_fingerprint'] == query_fp
+
+def _use_raw_cache(input_dict):
+    """
+    Return True if the deduplicated correlators are kept in the raw_cache of
+    this process. Incremental refreshes need the rows of every correlator,
+    so they always query the database.
+    """
+    return input_dict.get('raw_cache_budget') is not None and \
+        not input_dict.get('incremental', False)
 
-def gather_data(datatag, input_dict, out_format="gpl"):
+def _blocking_number(input_dict):
+    """
+    Return the blocking number of input_dict.
+    """
+    try:
+        blockno = int(input_dict['blocking'])
+    except:
+        blockno = 1
+    return blockno
+
+def _correlator_state(npt, rows):
+    """
+    Return the state needed to refresh the blocked data of the Lattice_Corrlator
+    `npt`, built from `rows`, incrementally: the largest data id (high-water
+    mark), the number of raw entries and configurations, the last
+    (trajectory, tsrc) of every series, the raw entries that are not part
+    of any block yet and the [series, trajectory, tsrc] of the
+    configurations whose conflicting duplicate entries were all discarded.
+    """
+    last_key = dict()
+    kept = set()
+    for iseries, itraj, itsrc in zip(npt._series, npt._trajectory, npt._tsrc):
+        last_key[npt.raw_index.series_names[iseries]] = [int(itraj), int(itsrc)]
+        kept.add((npt.raw_index.series_names[iseries], int(itraj), int(itsrc)))
+    discarded = set((str(series), trajectory, tsrc)
+                    for series, trajectory, tsrc, dataBZ2, data_id in rows) - kept
+    tail = []
+    for indx in npt.unblocked_rows():
+        series, trajectory, tsrc, dataBZ2, data_id = rows[npt._raw_rowindx[indx]]
+        tail.append([series, trajectory, tsrc, base64.b64encode(dataBZ2), data_id])
+    return {'high_water': max(row[4] for row in rows),
+            'n_rows': len(npt.raw_index),
+            'n_unique': len(npt.raw_unique_configId),
+            'no_tsrc': npt.no_tsrc,
+            'last_key': last_key,
+            'tail': tail,
+            'discarded': sorted([list(key) for key in discarded])}
+
+def _meta_output(meta_info, config_index):
+    """
+    Return the configurations `meta_info`, a ConfigIndex or a list of
+    configId strings, as a ConfigIndex if `config_index` is set and as a
+    list of configId strings otherwise.
+    """
+    if config_index:
+        if isinstance(meta_info, ConfigIndex):
+            return meta_info
+        return parse_config_index(meta_info)
+    if isinstance(meta_info, ConfigIndex):
+        return meta_info.configIds()
+    return meta_info
+
+def _combine_correlators(block_list, op_irrep):
+    """
+    Combine the blocked correlators of one datatag. `block_list` holds the
+    (config_index, output_data) of every correlator after Lattice_Corrlator.block.
+    For the 16 irrep, the correlators (16p and 16m) must come from the same
+    configurations and are averaged. Return (dlist, meta_info, tot), where
+    meta_info is the ConfigIndex of the blocks.
+    """
+    tot = 0 #count number of configurations found
+    dlist = [] #container for all data for given correlator
+    dlist_temp = []
+    configid_list = [] #for safety check later
+    for configId, output_data in block_list:
+        configid_list.append(configId)
+        if op_irrep == '16':
+            # For data with only multiple correlator names
+            dlist_temp.append(np.array(output_data))
+        else:
+            # For data with only one correlator name only
+            dlist.append(output_data)
+        tot += len(output_data)
+    meta_info = configid_list[-1]
+    if op_irrep == '16':
+        # check if all these correlators we average come from the same gauge configurations
+        if configid_list.count(configid_list[0]) != len(configid_list):
+            raise ValueError('Error in gathering data! Possible errors in generating data!')
+
+        tot = tot/len(dlist_temp)
+        with stage('average', correlators=len(dlist_temp), blocks=tot):
+            dlist = np.sum(np.array(dlist_temp),axis=0)/len(dlist_temp) # sum the raw value for meson and 16 = 16m + 16p
+    return dlist, meta_info, tot
+
+def _refresh_correlator(datatag, corr_name, corr_state, new_rows, input_dict):
+    """
+    Block the unblocked tail entries of a correlator together with its newly
+    ingested entries `new_rows`. Return the new blocked data, their configIds
+    and the new state, or None if the new entries do not simply extend the
+    series of the existing entries, or if they change the number of time
+    sources per configuration that is used for averaging.
+    """
+    # A new entry of a configuration whose conflicting duplicates were
+    # discarded may replace them (see load_db.bulk_load), so only a full
+    # rebuild can tell whether the configuration is still discarded
+    discarded = set(tuple(key) for key in corr_state.get('discarded', []))
+    for series, trajectory, tsrc, dataBZ2, data_id in new_rows:
+        if (series, trajectory, tsrc) in discarded:
+            return None
+        if series in corr_state['last_key'] and \
+           [trajectory, tsrc] <= corr_state['last_key'][series]:
+            return None
+    tail = [(str(series), trajectory, tsrc, base64.b64decode(dataBZ2), data_id)
+            for series, trajectory, tsrc, dataBZ2, data_id in corr_state['tail']]
+    rows = sorted(tail + list(new_rows), key=lambda row: (row[0], row[1], row[2], row[4]))
+    if len(rows) == 0:
+        return [], [], corr_state
+
+    from corr_db import Lattice_Corrlator
+    npt = Lattice_Corrlator(input_dict['db_name'], corr_name, datatag,
+                            'baryon', verbose=True, rows=rows,
+                            workers=input_dict.get('decode_workers'),
+                            pool_type=input_dict.get('decode_pool', 'thread'))
+    # Count the entries and configurations of the whole correlator
+    old_unique = set(['%s%s'%(series, str(trajectory).zfill(5))
+                      for series, trajectory, tsrc, dataBZ2, data_id in tail])
+    old_unique.update(['%s%s'%(series, str(trajectory).zfill(5))
+                       for series, (trajectory, tsrc) in corr_state['last_key'].iteritems()])
+    n_rows = corr_state['n_rows'] + len(npt.raw_index) - len(tail)
+    n_unique = corr_state['n_unique'] + len(npt.raw_unique_configId - old_unique)
+    npt.no_tsrc = int(math.floor(float(n_rows)/float(n_unique)))
+    if input_dict['avg_tsrc'] and npt.no_tsrc != corr_state['no_tsrc']:
+        return None
+    npt.block(block_no=_blocking_number(input_dict), avg_tsrc=input_dict['avg_tsrc'])
+
+    new_state = _correlator_state(npt, rows)
+    new_state['n_rows'] = n_rows
+    new_state['n_unique'] = n_unique
+    new_state['discarded'] = [list(key) for key in sorted(
+        set(tuple(key) for key in new_state['discarded']) | discarded)]
+    for series in corr_state['last_key']:
+        new_state['last_key'].setdefault(series, corr_state['last_key'][series])
+    return npt.output_data, npt.configId, new_state
+
+def _refresh_data(datatag, input_dict, key_list, state, data, meta_info):
+    """
+    Refresh the blocked data `data` with configIds `meta_info` read from the
+    cache of datatag with the entries that were added to the database since
+    the cache was built. New blocks are added to the end of their series.
+    Return the refreshed data, configIds and state, or None if the cache has
+    to be rebuilt from scratch.
+    """
+    from corr_db import fetch_correlators
+    new_rows_dict = fetch_correlators(input_dict['db_name'], key_list,
+                                      after_id=dict((corr_name, state[corr_name]['high_water'])
+                                                    for corr_name in key_list),
+                                      tuned=input_dict.get('tune_db', False))
+    new_state = dict()
+    new_data_list = []
+    new_configId_list = []
+    for corr_name in key_list:
+        print corr_name
+        print 'Found %s new entries' %len(new_rows_dict[corr_name])
+        refresh = _refresh_correlator(datatag, corr_name, state[corr_name],
+                                      new_rows_dict[corr_name], input_dict)
+        if refresh is None:
+            return None
+        new_data_list.append(refresh[0])
+        new_configId_list.append(refresh[1])
+        new_state[corr_name] = refresh[2]
+        new_state[corr_name]['high_water'] = max([state[corr_name]['high_water']] +
+                                                 [row[4] for row in new_rows_dict[corr_name]])
+    if new_configId_list.count(new_configId_list[0]) != len(new_configId_list):
+        return None
+    if len(new_configId_list[0]) == 0:
+        return data, meta_info, new_state
+    # sum the raw value for meson and 16 = 16m + 16p
+    new_data = np.sum(np.array(new_data_list),axis=0)/len(new_data_list)
+
+    # Append the new blocks to their series
+    series_data = dict()
+    series_configId = dict()
+    for idata, iconfigid in zip(list(data) + list(new_data), list(meta_info) + new_configId_list[0]):
+        iseries = _parse_configId([iconfigid.split('+')[0]])[0][0]
+        series_data.setdefault(iseries, []).append(idata)
+        series_configId.setdefault(iseries, []).append(iconfigid)
+    out_data = []
+    out_configId = []
+    for iseries in sorted(series_data):
+        out_data += series_data[iseries]
+        out_configId += series_configId[iseries]
+    print 'Added %s blocked configurations' %len(new_configId_list[0])
+    return out_data, out_configId, new_state
+
+def _stream_data(datatag, input_dict, key_list, save_name, meta_save_name, out_format):
+    """
+    Block the correlators of datatag with `stream_blocks` and write every
+    block to the cache files as soon as it is complete, so that only one
+    block is held in memory (the pickle format still collects the blocked
+    data before writing it). The files are written under temporary names and
+    moved in place at the end; the temporary files are removed if gathering
+    fails. Return the number of blocked configurations.
+    """
+    from corr_db import stream_blocks
+    blocks = stream_blocks(input_dict['db_name'], key_list, _blocking_number(input_dict),
+                           input_dict['avg_tsrc'], tuned=input_dict.get('tune_db', False))
+    configId = []
+    nt = None
+    with _replacing(save_name, meta_save_name) as (tmp_name, meta_tmp_name):
+        if out_format == "gpl":
+            fio = open(tmp_name, 'wb')
+            fio_meta = open(meta_tmp_name, 'wb')
+            try:
+                for iconfigid, idata in blocks:
+                    dump_gpl({datatag:[idata]}, {datatag:[iconfigid]}, fio, fio_meta)
+                    configId.append(iconfigid)
+            finally:
+                fio.close()
+                fio_meta.close()
+        elif out_format == "npy":
+            # Collect the raw data first since the .npy header needs the shape
+            raw_tmp_name = save_name + '.%s.raw.tmp' %os.getpid()
+            try:
+                fio = open(raw_tmp_name, 'wb')
+                try:
+                    for iconfigid, idata in blocks:
+                        np.asarray(idata, dtype='<f8').tofile(fio)
+                        configId.append(iconfigid)
+                        nt = len(idata)
+                finally:
+                    fio.close()
+                if len(configId) > 0:
+                    raw_data = np.memmap(raw_tmp_name, dtype='<f8', mode='r',
+                                         shape=(len(configId), nt))
+                    data = np.lib.format.open_memmap(tmp_name, mode='w+', dtype='<f8',
+                                                     shape=(len(configId), nt))
+                    chunk_size = max(1, 2**24//(8*nt))
+                    for start in range(0, len(configId), chunk_size):
+                        data[start:start+chunk_size] = raw_data[start:start+chunk_size]
+                    data.flush()
+                    del data, raw_data
+            finally:
+                if os.path.isfile(raw_tmp_name):
+                    os.remove(raw_tmp_name)
+            fio_meta = open(meta_tmp_name, 'w')
+            json.dump({'datatag': datatag,
+                       'shape': [len(configId), nt],
+                       'configId': configId}, fio_meta)
+            fio_meta.close()
+        elif out_format == "pickle":
+            data = []
+            for iconfigid, idata in blocks:
+                data.append(idata)
+                configId.append(iconfigid)
+            fio = open(tmp_name, 'wb')
+            fio_meta = open(meta_tmp_name, 'wb')
+            pickle.dump({datatag:data}, fio)
+            pickle.dump({datatag:configId}, fio_meta)
+            fio.close()
+            fio_meta.close()
+        if len(configId) == 0:
+            raise ValueError('No configurations found!')
+    print 'data file saved: %s' %(save_name)
+    print 'meta file saved: %s' %(meta_save_name)
+    return len(configId)
+
+def _record_cache(datatag, input_dict, key_list, save_name, meta_save_name, out_format,
+                  db_fp, extra_files=()):
+    """
+    Add freshly written cache files to the manifest and evict old ones if
+    the optional `cache_budget` of `input_dict` is exceeded.
+    """
+    output_dir = input_dict['data_dir']
+    with locked_manifest(output_dir) as manifest:
+        record_entry(manifest, save_name, meta_save_name, db_fp,
+                     query_fingerprint(datatag, key_list, input_dict, out_format),
+                     extra_files=extra_files)
+        if input_dict.get('cache_budget') is not None:
+            evict_entries(output_dir, manifest, float(input_dict['cache_budget']),
+                          keep=[save_name])
+
+def _cache_size(save_name, meta_save_name):
+    """
+    Total size of the cache files in bytes.
+    """
+    return os.path.getsize(save_name) + os.path.getsize(meta_save_name)
+
+@contextlib.contextmanager
+def _replacing(*file_names):
+    """
+    Yield temporary names next to `file_names` to write the new files to,
+    and move them over `file_names` once the block succeeds. Readers never
+    see a partly written file, and arrays memory-mapped from the old files
+    keep their data, since the old files are replaced and not truncated.
+    The temporary files are removed if the block fails.
+    """
+    tmp_names = [file_name + '.%s.tmp' %os.getpid() for file_name in file_names]
+    try:
+        yield tmp_names
+    except:
+        for tmp_name in tmp_names:
+            if os.path.isfile(tmp_name):
+                os.remove(tmp_name)
+        raise
+    for tmp_name, file_name in zip(tmp_names, file_names):
+        os.rename(tmp_name, file_name)
+
+def _write_cache(data_dict, meta_dict, save_name, meta_save_name, out_format,
+                 config_index=False):
+    """
+    Write data_dict and meta_dict to the cache files. Return them as they
+    would be read back from the cache. Any other `out_format` than 'npy',
+    'pickle' and 'gpl' (e.g. 'matrix') writes the one array of data_dict
+    with the json meta dictionary of meta_dict (see _save_npy); they are
+    returned as given.
+    """
+    with stage('cache_write', format=out_format) as record:
+        if out_format == "npy":
+            dump_npy(data_dict, meta_dict, save_name, meta_save_name)
+            # Return the same memory-mapped view as a cache hit
+            data_dict, meta_dict = load_npy(save_name, meta_save_name,
+                                            config_index=config_index)
+        elif out_format not in ["pickle", "gpl"]:
+            if len(data_dict) != 1:
+                raise ValueError("data_dict should only have one key!")
+            for datatag in data_dict:
+                _save_npy(data_dict[datatag], meta_dict[datatag], save_name, meta_save_name)
+        else:
+            # These formats keep the legacy configId strings
+            meta_dict = dict((datatag, _meta_output(meta_info, False))
+                             for datatag, meta_info in meta_dict.iteritems())
+            with _replacing(save_name, meta_save_name) as (tmp_name, meta_tmp_name):
+                fio = open(tmp_name, 'wb')
+                fio_meta = open(meta_tmp_name, 'wb')
+                # Dump to pickle cache file
+                if out_format == "pickle":
+                    pickle.dump(data_dict, fio)
+                    pickle.dump(meta_dict, fio_meta)
+                elif out_format == "gpl":
+                    dump_gpl(data_dict, meta_dict, fio, fio_meta)
+                fio.close()
+                fio_meta.close()
+        print 'data file saved: %s' %(save_name)
+        print 'meta file saved: %s' %(meta_save_name)
+        record['bytes'] = _cache_size(save_name, meta_save_name)
+    return data_dict, meta_dict
+
+def _read_cache(save_name, meta_save_name, out_format, config_index=False):
+    """
+    Read data_dict and meta_dict from the cache files.
+    """
+    with stage('cache_read', format=out_format) as record:
+        print 'Loading existing file: %s ... ' %save_name
+        print 'Loading existing meta: %s ... ' %meta_save_name
+        if out_format == "npy":
+            data_dict, meta_dict = load_npy(save_name, meta_save_name,
+                                            config_index=config_index)
+        else:
+            fio = open(save_name,'r')
+            fio_meta = open(meta_save_name,'r')
+            if out_format == "pickle":
+                data_dict =  pickle.load(fio)
+                meta_dict =  pickle.load(fio_meta)
+            elif out_format == "gpl":
+                data_dict, meta_dict = load_gpl(fio, fio_meta)
+            fio.close()
+            fio_meta.close()
+        record['bytes'] = _cache_size(save_name, meta_save_name)
+    return data_dict, meta_dict
+
+def gather_data(datatag, input_dict, out_format="gpl", rows_dict=None, db_fp=None,
+                npt_dict=None):
     """
     Gather the set of data given by datatag.
-    If data cache is found at directory `output_dir` and `input_dict`
-    requires no overwrite, it will read it directly without queuing 
-    the database; otherwise, it will dump files to 
-    `output_dir`. The out_format accepts either `gpl` or `pickle`
-    that determines the output format.
+    If data cache is found at directory `output_dir` and the cache manifest
+    shows that it is up to date with the database, it will read it directly
+    without queuing the database, unless `input_dict` requires overwrite;
+    otherwise, it will dump files to `output_dir`. Cache files are evicted
+    in least recently used order once their total size exceeds the optional
+    `cache_budget` (in bytes) of `input_dict`. The out_format accepts either `gpl`, `pickle` or `npy`
+    that determines the output format. With `npy`, the data is returned as
+    a read-only (nconf, nt) array memory-mapped from the cache file.
+    If `input_dict` sets `incremental`, an outdated cache is refreshed with
+    only the entries added to the database since it was built, as long as
+    they extend the existing series. If it sets `streaming`, the data is
+    blocked with `stream_blocks` and written to the cache block by block,
+    and the result is read back from the cache.
+    `rows_dict` is an optional dictionary returned by `fetch_correlators`
+    that already contains the rows of the correlators of datatag; if given,
+    the database is not queried again. If `input_dict` sets
+    `raw_cache_budget`, the deduplicated correlators are kept in the
+    raw_cache of this process (see corr_db.CorrelatorCache), so gathering
+    them again with another blocking does not query the database, and
+    `rows_dict` only needs the correlators that are not cached.
+    `npt_dict` is an optional dictionary of Lattice_Corrlator objects of
+    the correlators of datatag, which are blocked instead of reading the
+    correlators (see gather_batch).
+    The configurations are given as lists of configId strings, or as
+    corr_db.ConfigIndex objects if `input_dict` sets `config_index`. `db_fp` is the `db_fingerprint` of the
+    database, which is computed if not given.
 
     Output:
         dictionary with raw data with datatags as keys 
     """
-    if out_format != "gpl" and out_format != "pickle":
-        raise ValueError("out_format needs to be gpl or pickle!")
+    with tagged(datatag=datatag):
+        with stage('gather'):
+            data_dict, meta_dict = _gather_data(datatag, input_dict, out_format, rows_dict,
+                                                db_fp, npt_dict)
+    meta_dict = dict((tag, _meta_output(meta_info, input_dict.get('config_index', False)))
+                     for tag, meta_info in meta_dict.iteritems())
+    return data_dict, meta_dict
+
+def _gather_data(datatag, input_dict, out_format, rows_dict, db_fp, npt_dict):
+    """
+    Body of gather_data.
+    """
+    if out_format not in ["gpl", "pickle", "npy"]:
+        raise ValueError("out_format needs to be gpl, pickle or npy!")
 
     #tagging data for internal identification within the fitter
     key_list = _generate_correlator_keys_baryon(datatag, input_dict)
     print "datatag: %s" %(datatag)
 
-    #save name for the dataset
-    #TODO: add this data back to database to have a more coherent data
-    #management.
     output_dir = input_dict['data_dir']
-    save_name = output_dir + '/' + 'raw_' + datatag + '_' + 'baryon' +\
-                "_tsrcavg" + str(int(input_dict['avg_tsrc'])) + "_blocking" + str(input_dict['blocking']) +\
-                ".%s"%out_format #use datatag as file name
-    meta_save_name = output_dir + '/' + 'meta_' + datatag + '_' + 'baryon' +\
-                     "_tsrcavg" + str(int(input_dict['avg_tsrc'])) + "_blocking" + str(input_dict['blocking']) +\
-                     '.%s'%out_format 
-    #overwriting warning
-    if (os.path.isfile(save_name) is False or os.path.isfile(meta_save_name) is False) or (input_dict['overwrite'] is True):
-        if input_dict['overwrite'] and os.path.isfile(save_name):
+    save_name, meta_save_name = _cache_names(datatag, input_dict, out_format)
+    state_name = _state_name(save_name)
+    if db_fp is None:
+        db_fp = db_fingerprint(input_dict['db_name'])
+    manifest = load_manifest(output_dir)
+    if not _need_query(datatag, input_dict, out_format, db_fp=db_fp, manifest=manifest):
+        data_dict, meta_dict = _read_cache(save_name, meta_save_name, out_format,
+                                           config_index=input_dict.get('config_index', False))
+        touch_entry(save_name)
+        return data_dict, meta_dict
+
+    refresh = None
+    if _can_refresh(datatag, input_dict, out_format, manifest=manifest):
+        print 'Refreshing existing file %s with new data' %save_name
+        start_time = time.time()
+        data_dict, meta_dict = _read_cache(save_name, meta_save_name, out_format)
+        fio_state = open(state_name, 'r')
+        state = json.load(fio_state)
+        fio_state.close()
+        with stage('refresh'):
+            refresh = _refresh_data(datatag, input_dict, key_list, state,
+                                    np.array(data_dict[datatag]), meta_dict[datatag])
+        del data_dict
+        if refresh is None:
+            print 'WARNING: Cannot refresh %s incrementally. Rebuilding it.' %save_name
+        else:
+            dlist, meta_info, state = refresh
+            tot = len(meta_info)
+            print "time to refresh: %.1fs" %((time.time()-start_time))
+
+    if refresh is None and input_dict.get('streaming', False):
+        if os.path.isfile(save_name):
+            print 'WARNING: Overwriting existing file %s' %save_name
+        start_time = time.time()
+        with stage('stream', format=out_format) as record:
+            tot = _stream_data(datatag, input_dict, key_list, save_name, meta_save_name,
+                               out_format)
+            record['blocks'] = tot
+        print "time to query: %.1fs" %((time.time()-start_time))
+        print 'Total unique configurations (average over tsrc): %d' %tot
+        data_dict, meta_dict = _read_cache(save_name, meta_save_name, out_format,
+                                           config_index=input_dict.get('config_index', False))
+        if os.path.isfile(state_name):
+            # The state of an earlier build is outdated now
+            os.remove(state_name)
+        _record_cache(datatag, input_dict, key_list, save_name, meta_save_name,
+                      out_format, db_fp)
+        return data_dict, meta_dict
+
+    if refresh is None:
+        if os.path.isfile(save_name):
             print 'WARNING: Overwriting existing file %s' %save_name
 
-        tot = 0 #count number of configurations found
-        dlist = [] #container for all data for given correlator
-        if input_dict['op_irrep'] == '16':
-            dlist_temp = []
-        configid_list = [] #for safety check later
+        from corr_db import Lattice_Corrlator, fetch_correlators, raw_cache
+        block_list = [] # (config_index, output_data) of every correlator
+        state = dict() # for incremental refreshes
         start_time = time.time()
 
         # find blocking number
-        try:
-            blockno = int(input_dict['blocking'])
-        except:
-            blockno = 1
+        blockno = _blocking_number(input_dict)
         if blockno == 1:
             print 'No blocking data!'
         else:
             print 'Block data by %s consecutive trajectories' %blockno
+        if npt_dict is None and _use_raw_cache(input_dict):
+            # Correlators read for an earlier blocking are not queried again
+            npt_dict = raw_cache(input_dict['raw_cache_budget']).get(
+                input_dict['db_name'], key_list, db_fp, rows_dict=rows_dict,
+                tuned=input_dict.get('tune_db', False),
+                workers=input_dict.get('decode_workers'),
+                pool_type=input_dict.get('decode_pool', 'thread'))
+        elif npt_dict is None:
+            npt_dict = dict()
+            if rows_dict is None:
+                rows_dict = fetch_correlators(input_dict['db_name'], key_list,
+                                              tuned=input_dict.get('tune_db', False))
         for corr_name in key_list:
             print corr_name
-            meta_info = []
-            # Gather entries from database
-            npt = Lattice_Corrlator(input_dict['db_name'], corr_name, datatag,
-                                            'baryon', verbose=True)
-            npt.block(block_no=blockno, avg_tsrc=input_dict['avg_tsrc'])
-
-            configid_list.append(npt.configId)
-            if meta_info == []: # Only need to do this once since they are all the same if done correctly
-                meta_info = npt.configId
-            if input_dict['op_irrep'] == '16':
-                # For data with only multiple correlator names
-                dlist_temp.append([])
-                (dlist_temp[-1]) = npt.output_data
+            if corr_name in npt_dict:
+                npt = npt_dict[corr_name]
             else:
-                # For data with only one correlator name only
-                dlist.append(npt.output_data)
-
-            try:
-                # cast to numpy all_correlator_keys
-                dlist_temp[-1] = np.array(dlist_temp[-1])
-            except:
-                pass
-            tot += npt.nconf
-        if input_dict['op_irrep'] == '16':
-            # check if all these correlators we average come from the same gauge configurations
-            if configid_list.count(configid_list[0]) != len(configid_list):
-                raise ValueError('Error in gathering data! Possible errors in generating data!')
-
-            tot = tot/len(dlist_temp)
-            dlist = np.sum(np.array(dlist_temp),axis=0)/len(dlist_temp) # sum the raw value for meson and 16 = 16m + 16p
-        print 'Total unique configurations (average over tsrc): %d' %tot
-        if tot == 0:
-            raise ValueError('No configurations found!')
+                # Gather entries from database
+                npt = Lattice_Corrlator(input_dict['db_name'], corr_name, datatag,
+                                                'baryon', verbose=True,
+                                                rows=rows_dict[corr_name],
+                                                workers=input_dict.get('decode_workers'),
+                                                pool_type=input_dict.get('decode_pool', 'thread'))
+            npt.block(block_no=blockno, avg_tsrc=input_dict['avg_tsrc'])
+            if input_dict.get('incremental', False):
+                state[corr_name] = _correlator_state(npt, rows_dict[corr_name])
+            block_list.append((npt.config_index, npt.output_data))
+        dlist, meta_info, tot = _combine_correlators(block_list, input_dict['op_irrep'])
         print "time to query: %.1fs" %((time.time()-start_time))
+    print 'Total unique configurations (average over tsrc): %d' %tot
+    if tot == 0:
+        raise ValueError('No configurations found!')
 
-        data_dict = dict()
-        meta_dict = dict()
-        data_dict[datatag] = list(dlist)
-        meta_dict[datatag] = meta_info
-        
-        if len(meta_info) != len(list(dlist)):
-            raise ValueError("Inconsistent length between meta_info and dlist!")
-        fio = open(save_name, 'wb')
-        fio_meta = open(meta_save_name, 'wb')
-        # Dump to pickle cache file
-        if out_format == "pickle":
-            pickle.dump(data_dict, fio)
-            pickle.dump(meta_dict, fio_meta)
-        elif out_format == "gpl":
-            dump_gpl(data_dict, meta_dict, fio, fio_meta)
-        fio.close()
-        fio_meta.close()
-        print 'data file saved: %s' %(save_name)
-        print 'meta file saved: %s' %(meta_save_name)
-    else: #overwrite == False
-        fio = open(save_name,'r')
-        fio_meta = open(meta_save_name,'r')
-        #load the file if found in directory
-        print 'Loading existing file: %s ... ' %save_name
-        print 'Loading existing meta: %s ... ' %meta_save_name
-        if out_format == "pickle":
-            data_dict =  pickle.load(fio)
-            meta_dict =  pickle.load(fio_meta)
-        elif out_format == "gpl":
-            data_dict, meta_dict = load_gpl(fio, fio_meta)
-        fio.close()
-        fio_meta.close()
+    data_dict = dict()
+    meta_dict = dict()
+    data_dict[datatag] = list(dlist)
+    meta_dict[datatag] = meta_info
+    
+    if len(meta_info) != len(list(dlist)):
+        raise ValueError("Inconsistent length between meta_info and dlist!")
+    data_dict, meta_dict = _write_cache(data_dict, meta_dict, save_name, meta_save_name,
+                                        out_format,
+                                        config_index=input_dict.get('config_index', False))
+    extra_files = []
+    if input_dict.get('incremental', False):
+        fio_state = open(state_name, 'w')
+        json.dump(state, fio_state)
+        fio_state.close()
+        extra_files.append(state_name)
+    elif os.path.isfile(state_name):
+        # The state of an earlier build is outdated now
+        os.remove(state_name)
+    _record_cache(datatag, input_dict, key_list, save_name, meta_save_name,
+                  out_format, db_fp, extra_files=extra_files)
     return data_dict, meta_dict
 
-def gather_dataset(input_dict):
+def _datatag_list(input_dict):
+    """
+    Return the datatags of all source and sink classes in `input_dict`.
+    """
+    datatag_list = []
+    for src_class in input_dict['src_class_list']:
+        for sink_class in input_dict['sink_class_list']:
+            datatag = generate_tag_baryon(input_dict['op_irrep'], 
+                                          input_dict['op_irrep'],
+                                          src_class, sink_class,
+                                          '000', mass=input_dict['mass'],
+                                          ensemble=input_dict['ensemble'])
+            datatag_list.append(datatag)
+    return datatag_list
+
+def _gather_data_worker(args):
+    """
+    Run gather_data for one datatag in a worker process of gather_dataset.
+    The output is captured so that the log of every datatag is printed as one
+    piece. Return (datatag, data_dict, meta_dict, log, error, records);
+    data_dict is None for the npy format since the parent maps the cache
+    file itself, and records are the metrics records of the worker.
+    """
+    datatag, input_dict, out_format, db_fp = args
+    if input_dict.get('decode_pool') == 'process':
+        # Pool workers cannot start processes of their own
+        input_dict = dict(input_dict, decode_pool='thread')
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    data_dict = None
+    meta_dict = None
+    error = None
+    try:
+        with recording() as recorder:
+            data_dict, meta_dict = gather_data(datatag, input_dict, out_format=out_format,
+                                               db_fp=db_fp)
+        if out_format == "npy":
+            data_dict = None
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        log = sys.stdout.getvalue()
+        sys.stdout = stdout
+    return datatag, data_dict, meta_dict, log, error, recorder.records
+
+def gather_dataset(input_dict, workers=None, publish=False):
     """
     Gather a set data according to keywords in input_dict.
     If data cache is found at directory `output_dir` and `input_dict`
     requires no overwrite, it will read it directly without queuing 
     the database; otherwise, it will dump pickle files to 
     `output_dir`
+    If `workers` (or the `workers` key of input_dict) is larger than one,
+    the datatags are gathered in a pool of that many processes, each with
+    its own read-only database connection.
+    If `input_dict` sets `metrics_file`, the metrics records of all stages
+    (see metrics.py) are appended to it as JSON lines.
+    If `publish` is True, the data is copied into a shared-memory segment
+    (see shared_data.py) and (data_dict, meta_dict, shared) is returned,
+    where data_dict holds read-only views on the segment and
+    shared.descriptor lets worker processes attach to it without copying.
 
     Output:
         dictionary with raw data with datatags as keys 
     """
+    with _metrics_file(input_dict):
+        with tagged(ensemble=input_dict['ensemble'], db_name=input_dict['db_name']):
+            with stage('gather_dataset'):
+                data_dict, meta_dict = _gather_dataset(input_dict, workers)
+            if not publish:
+                return data_dict, meta_dict
+            with stage('publish', datatags=len(data_dict)) as record:
+                shared = publish_dataset(data_dict, meta_dict)
+                record['bytes'] = shared.descriptor['size']
+            return shared.data_dict, shared.meta_dict, shared
+
+@contextlib.contextmanager
+def _metrics_file(input_dict):
+    """
+    Append the metrics records inside the block to the `metrics_file` of
+    `input_dict`, if it is set.
+    """
+    hook = None
+    if input_dict.get('metrics_file') is not None:
+        hook = JsonLinesHook(input_dict['metrics_file'])
+        add_hook(hook)
+    try:
+        yield
+    finally:
+        if hook is not None:
+            remove_hook(hook)
+
+def _gather_dataset(input_dict, workers):
+    """
+    Body of gather_dataset.
+    """
     dlist_dict = dict() 
     meta_dict_all = dict()
+    if workers is None:
+        workers = int(input_dict.get('workers', 1))
     # First construct all datatags based on input_dict
-    input_dict['datatag_list'] = []
-    for src_class in input_dict['src_class_list']:
-        for sink_class in input_dict['sink_class_list']:
-            datatag = generate_tag_baryon(input_dict['op_irrep'], 
-                                          input_dict['op_irrep'],
-                                          src_class, sink_class,
-                                          '000', mass=input_dict['mass'],
-                                          ensemble=input_dict['ensemble'])
-            input_dict['datatag_list'].append(datatag)
+    out_format = input_dict.get('out_format', 'gpl')
+    input_dict['datatag_list'] = _datatag_list(input_dict)
+    db_fp = db_fingerprint(input_dict['db_name'])
+
+    if workers > 1 and len(input_dict['datatag_list']) > 1:
+        # Every worker queries its own correlators
+        import multiprocessing
+        pool = multiprocessing.Pool(min(workers, len(input_dict['datatag_list'])))
+        try:
+            results = pool.imap(_gather_data_worker,
+                                [(datatag, input_dict, out_format, db_fp)
+                                 for datatag in input_dict['datatag_list']])
+            for datatag, data_dict, meta_dict, log, error, records in results:
+                print log,
+                replay(records)
+                if error is not None:
+                    print error
+                    raise ValueError("Error in gathering %s!" %datatag)
+                if data_dict is None:
+                    data_dict, meta_dict = load_npy(*_cache_names(datatag, input_dict, out_format),
+                                                    config_index=input_dict.get('config_index', False))
+                dlist_dict[datatag] = data_dict[datatag]
+                meta_dict_all[datatag] = meta_dict[datatag]
+        finally:
+            pool.close()
+            pool.join()
+        return dlist_dict, meta_dict_all
+
+    # Query all correlators that are not cached at once
+    manifest = load_manifest(input_dict['data_dir'])
+    corr_name_list = []
+    for datatag in _full_builds(input_dict, out_format, db_fp, manifest):
+        corr_name_list += _generate_correlator_keys_baryon(datatag, input_dict)
+    if _use_raw_cache(input_dict) and len(corr_name_list) != 0:
+        from corr_db import raw_cache
+        corr_name_list = [corr_name for corr_name in corr_name_list
+                          if not raw_cache().cached(input_dict['db_name'], db_fp, corr_name)]
+    rows_dict = dict()
+    if len(corr_name_list) != 0:
+        from corr_db import fetch_correlators
+        rows_dict = fetch_correlators(input_dict['db_name'], corr_name_list,
+                                      tuned=input_dict.get('tune_db', False))
 
     # Gather all data
     for datatag in input_dict['datatag_list']:
-        data_dict, meta_dict = gather_data(datatag, input_dict)
+        key_list = _generate_correlator_keys_baryon(datatag, input_dict)
+        if _use_raw_cache(input_dict):
+            data_dict, meta_dict = gather_data(datatag, input_dict, out_format=out_format,
+                rows_dict=dict((corr_name, rows_dict.pop(corr_name)) for corr_name in key_list
+                               if corr_name in rows_dict),
+                db_fp=db_fp)
+        elif all(corr_name in rows_dict for corr_name in key_list):
+            # Hand over the rows and release them once they are used
+            data_dict, meta_dict = gather_data(datatag, input_dict, out_format=out_format,
+                rows_dict=dict((corr_name, rows_dict.pop(corr_name)) for corr_name in key_list),
+                db_fp=db_fp)
+        else:
+            data_dict, meta_dict = gather_data(datatag, input_dict, out_format=out_format,
+                                               db_fp=db_fp)
         dlist_dict[datatag] = data_dict[datatag]
         meta_dict_all[datatag] = meta_dict[datatag]
 
     return dlist_dict, meta_dict_all
 
+def _full_builds(input_dict, out_format, db_fp, manifest):
+    """
+    Return the datatags of `input_dict` whose cache has to be built from all
+    entries of their correlators.
+    """
+    return [datatag for datatag in input_dict['datatag_list']
+            if _need_query(datatag, input_dict, out_format, db_fp=db_fp, manifest=manifest) and
+            not _can_refresh(datatag, input_dict, out_format, manifest=manifest) and
+            not input_dict.get('streaming', False)]
+
+def plan_batch(input_list):
+    """
+    Plan the gather of all input dictionaries in `input_list`, e.g. the
+    documents of a multi-document yaml file. Return a list with the datatags
+    of every input dictionary that need the rows of their correlators, and
+    a dictionary {database path: [correlator names]} of the fetches needed,
+    with every correlator of every database once.
+    """
+    db_fp_dict = dict()
+    build_list = []
+    fetch_plan = collections.OrderedDict()
+    for input_dict in input_list:
+        input_dict['datatag_list'] = _datatag_list(input_dict)
+        db_path = os.path.abspath(input_dict['db_name'])
+        if db_path not in db_fp_dict:
+            db_fp_dict[db_path] = db_fingerprint(db_path)
+        out_format = input_dict.get('out_format', 'gpl')
+        manifest = load_manifest(input_dict['data_dir'])
+        build = _full_builds(input_dict, out_format, db_fp_dict[db_path], manifest)
+        build_list.append(build)
+        corr_names = fetch_plan.setdefault(db_path, [])
+        for datatag in build:
+            corr_names += [corr_name for corr_name in
+                           _generate_correlator_keys_baryon(datatag, input_dict)
+                           if corr_name not in corr_names]
+    return build_list, dict((db_path, corr_names) for db_path, corr_names
+                            in fetch_plan.iteritems() if len(corr_names) > 0)
+
+def gather_batch(input_list, workers=None):
+    """
+    Gather the data sets of all input dictionaries in `input_list` like
+    gather_dataset, but read every correlator of every database only once.
+    Input dictionaries that differ only in e.g. 'blocking', 'avg_tsrc' or
+    the class lists share their correlators: the correlators of all data
+    sets that are not cached are fetched with one query per database, up
+    to `workers` databases at a time in threads, and every correlator is
+    decoded once and blocked for every data set that uses it. The rows and
+    correlators are released once the last data set that uses them is
+    done. The 'workers' keys of the input dictionaries are ignored.
+
+    Output:
+        list of the (data_dict, meta_dict) of gather_dataset of every input
+        dictionary
+    """
+    if isinstance(input_list, dict):
+        input_list = [input_list]
+    with stage('plan_batch', documents=len(input_list)) as record:
+        build_list, fetch_plan = plan_batch(input_list)
+        record['correlators'] = sum(len(corr_names) for corr_names in fetch_plan.itervalues())
+    db_fp_dict = dict()
+    uses = collections.Counter()
+    tuned = dict()
+    for input_dict, build in zip(input_list, build_list):
+        db_path = os.path.abspath(input_dict['db_name'])
+        # A database is only opened tuned if every input asks for it
+        tuned[db_path] = tuned.get(db_path, True) and input_dict.get('tune_db', False)
+        for datatag in build:
+            for corr_name in _generate_correlator_keys_baryon(datatag, input_dict):
+                uses[(db_path, corr_name)] += 1
+
+    rows = dict()
+    if len(fetch_plan) != 0:
+        from corr_db import fetch_correlators, CorrelatorCache
+        def _fetch(db_path):
+            return db_path, fetch_correlators(db_path, fetch_plan[db_path], tuned=tuned[db_path])
+        if workers is not None and workers > 1 and len(fetch_plan) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(workers, len(fetch_plan)))
+            try:
+                rows = dict(pool.map(_fetch, list(fetch_plan)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            rows = dict(_fetch(db_path) for db_path in fetch_plan)
+        npt_cache = CorrelatorCache(float('inf'))
+
+    result_list = []
+    for input_dict, build in zip(input_list, build_list):
+        db_path = os.path.abspath(input_dict['db_name'])
+        if db_path not in db_fp_dict:
+            db_fp_dict[db_path] = db_fingerprint(db_path)
+        out_format = input_dict.get('out_format', 'gpl')
+        dlist_dict = dict()
+        meta_dict_all = dict()
+        with _metrics_file(input_dict):
+            with tagged(ensemble=input_dict['ensemble'], db_name=input_dict['db_name']):
+                with stage('gather_dataset'):
+                    for datatag in input_dict['datatag_list']:
+                        if datatag not in build:
+                            data_dict, meta_dict = gather_data(datatag, input_dict,
+                                out_format=out_format, db_fp=db_fp_dict[db_path])
+                        else:
+                            key_list = _generate_correlator_keys_baryon(datatag, input_dict)
+                            if input_dict.get('incremental', False):
+                                # The incremental state needs the rows
+                                data_dict, meta_dict = gather_data(datatag, input_dict,
+                                    out_format=out_format,
+                                    rows_dict=dict((corr_name, rows[db_path][corr_name])
+                                                   for corr_name in key_list),
+                                    db_fp=db_fp_dict[db_path])
+                            else:
+                                npt_dict = npt_cache.get(db_path, key_list, db_fp_dict[db_path],
+                                    rows_dict=rows[db_path],
+                                    workers=input_dict.get('decode_workers'),
+                                    pool_type=input_dict.get('decode_pool', 'thread'))
+                                data_dict, meta_dict = gather_data(datatag, input_dict,
+                                    out_format=out_format, db_fp=db_fp_dict[db_path],
+                                    npt_dict=npt_dict)
+                            for corr_name in key_list:
+                                uses[(db_path, corr_name)] -= 1
+                                if uses[(db_path, corr_name)] == 0:
+                                    rows[db_path].pop(corr_name)
+                                    npt_cache.discard(db_path, corr_name)
+                        dlist_dict[datatag] = data_dict[datatag]
+                        meta_dict_all[datatag] = meta_dict[datatag]
+        result_list.append((dlist_dict, meta_dict_all))
+    return result_list
+
+def _cache_fresh(input_dict, save_name, meta_save_name, db_fp, query_fp, manifest=None):
+    """
+    Return True if the cache files `save_name` and `meta_save_name` exist,
+    no overwrite is requested and the manifest shows that they were built
+    from the database with fingerprint `db_fp` by the query `query_fp`.
+    Existing files are used as they are if the database cannot be found.
+    """
+    if input_dict.get('overwrite', False) is True or not os.path.isfile(save_name) or \
+       not os.path.isfile(meta_save_name):
+        return False
+    if db_fp is None:
+        print 'WARNING: Cannot find database %s, using existing cache file %s' %(
+            input_dict['db_name'], save_name)
+        return True
+    if manifest is None:
+        manifest = load_manifest(input_dict['data_dir'])
+    return is_fresh(manifest, save_name, db_fp, query_fp)
+
+def _matrix_names(input_dict):
+    """
+    Return the tag of the correlator matrix of `input_dict` and the names
+    of its data and meta cache files.
+    """
+    tag = generate_tag_baryon(input_dict['op_irrep'], input_dict['op_irrep'],
+                              '-'.join([str(i) for i in input_dict['src_class_list']]),
+                              '-'.join([str(i) for i in input_dict['sink_class_list']]),
+                              '000', mass=input_dict['mass'], ensemble=input_dict['ensemble'])
+    save_name = input_dict['data_dir'] + '/' + 'matrix_' + tag + '_' + 'baryon' +\
+                "_tsrcavg" + str(int(input_dict['avg_tsrc'])) + "_blocking" + str(input_dict['blocking'])
+    return tag, save_name + '.npy', save_name + '.json'
+
+def gather_matrix(input_dict):
+    """
+    Gather the correlator matrix of all source and sink classes of
+    `input_dict` in one (n_src, n_sink, nconf, nt) float64 array, in the
+    order of 'src_class_list' and 'sink_class_list'. Every element is the
+    data gather_dataset returns for its datatag, but all elements are
+    filled directly from the blocked correlators and must have been blocked
+    over identical configurations. The correlators are read with one query,
+    or from the raw_cache if `input_dict` sets `raw_cache_budget`.
+    The matrix is cached in one .npy file with a json meta file in
+    'data_dir', which is reused like the other cache files (see
+    cache_manifest.py), and returned read-only memory-mapped from it.
+
+    Output:
+        the array and a dictionary with the 'configId' of every
+        configuration, the 'src_class_list', the 'sink_class_list' and the
+        'datatags' of all elements
+    """
+    with _metrics_file(input_dict):
+        with tagged(ensemble=input_dict['ensemble'], db_name=input_dict['db_name']):
+            with stage('gather_matrix'):
+                return _gather_matrix(input_dict)
+
+def _gather_matrix(input_dict):
+    """
+    Body of gather_matrix.
+    """
+    tag, save_name, meta_save_name = _matrix_names(input_dict)
+    datatags = [[generate_tag_baryon(input_dict['op_irrep'], input_dict['op_irrep'],
+                                     src_class, sink_class, '000', mass=input_dict['mass'],
+                                     ensemble=input_dict['ensemble'])
+                 for sink_class in input_dict['sink_class_list']]
+                for src_class in input_dict['src_class_list']]
+    key_dict = dict()
+    corr_names = []
+    for datatag in sum(datatags, []):
+        key_dict[datatag] = _generate_correlator_keys_baryon(datatag, input_dict)
+        corr_names += [name for name in key_dict[datatag] if name not in corr_names]
+    db_fp = db_fingerprint(input_dict['db_name'])
+    query_fp = query_fingerprint(tag, corr_names, input_dict, 'matrix')
+    if _cache_fresh(input_dict, save_name, meta_save_name, db_fp, query_fp):
+        matrix, meta_info = _read_matrix(save_name, meta_save_name)
+        touch_entry(save_name)
+        return matrix, meta_info
+
+    if os.path.isfile(save_name):
+        print 'WARNING: Overwriting existing file %s' %save_name
+    start_time = time.time()
+    from corr_db import CorrelatorCache, raw_cache
+    if _use_raw_cache(input_dict):
+        corr_cache = raw_cache(input_dict['raw_cache_budget'])
+    else:
+        corr_cache = CorrelatorCache(0) # only reads the correlators
+    npt_dict = corr_cache.get(input_dict['db_name'], corr_names, db_fp,
+                              tuned=input_dict.get('tune_db', False),
+                              workers=input_dict.get('decode_workers'),
+                              pool_type=input_dict.get('decode_pool', 'thread'))
+    blockno = _blocking_number(input_dict)
+    matrix = None
+    configId = None
+    for isrc, datatag_row in enumerate(datatags):
+        for isink, datatag in enumerate(datatag_row):
+            block_list = []
+            for corr_name in key_dict[datatag]:
+                npt = npt_dict[corr_name]
+                npt.block(block_no=blockno, avg_tsrc=input_dict['avg_tsrc'])
+                if configId is None:
+                    configId = npt.config_index
+                    if len(configId) == 0:
+                        raise ValueError('No configurations found!')
+                    matrix = np.empty([len(datatags), len(datatag_row), npt.nconf, npt.nt])
+                elif npt.config_index != configId:
+                    raise ValueError('%s is not blocked over the same configurations as %s!'
+                                     %(corr_name, datatags[0][0]))
+                block_list.append(npt.output_array)
+            # Average 16p and 16m in place, adding up in the same order as
+            # the sum in _combine_correlators
+            with stage('average', correlators=len(block_list), datatag=datatag):
+                matrix[isrc,isink] = block_list[0]
+                for output_array in block_list[1:]:
+                    matrix[isrc,isink] += output_array
+                matrix[isrc,isink] /= len(block_list)
+    print "time to query: %.1fs" %((time.time()-start_time))
+    print 'Total unique configurations (average over tsrc): %d' %len(configId)
+
+    meta_info = {'configId': configId.configIds(),
+                 'src_class_list': list(input_dict['src_class_list']),
+                 'sink_class_list': list(input_dict['sink_class_list']),
+                 'datatags': datatags}
+    _write_cache({tag: matrix}, {tag: dict(meta_info, tag=tag)}, save_name, meta_save_name,
+                 'matrix')
+    _record_cache(tag, input_dict, corr_names, save_name, meta_save_name, 'matrix', db_fp)
+    # Return the same memory-mapped view as a cache hit
+    return _read_matrix(save_name, meta_save_name)
+
+def _read_matrix(save_name, meta_save_name):
+    """
+    Load the matrix cache files written by gather_matrix.
+    """
+    with stage('cache_read', format='matrix') as record:
+        fio_meta = open(meta_save_name, 'r')
+        meta = json.load(fio_meta)
+        fio_meta.close()
+        matrix = np.load(save_name, mmap_mode='r')
+        if list(np.shape(matrix)) != meta['shape'] or np.shape(matrix)[2] != len(meta['configId']):
+            raise ValueError("Mistmatch in shape of data and metadata!")
+        record['bytes'] = _cache_size(save_name, meta_save_name)
+    meta_info = {'configId': [str(i) for i in meta['configId']],
+                 'src_class_list': meta['src_class_list'],
+                 'sink_class_list': meta['sink_class_list'],
+                 'datatags': [[str(i) for i in row] for row in meta['datatags']]}
+    return matrix, meta_info
+
+def _resample_tag(input_dict):
+    """
+    Return the resampling method of `input_dict` with its parameters, e.g.
+    'jackknife' or 'bootstrap1000_seed0', and the number of bootstrap
+    samples and seed.
+    """
+    method = input_dict.get('resample', 'jackknife')
+    nboot = int(input_dict.get('nboot', 1000))
+    seed = int(input_dict.get('seed', 0))
+    if method == 'jackknife':
+        return method, nboot, seed
+    elif method == 'bootstrap':
+        return 'bootstrap%s_seed%s' %(nboot, seed), nboot, seed
+    raise ValueError("resample needs to be jackknife or bootstrap!")
+
+def _resample_names(datatag, input_dict):
+    """
+    Return the data and meta cache file names of the resampled data of
+    datatag, next to its raw cache files.
+    """
+    resample_tag, nboot, seed = _resample_tag(input_dict)
+    return [os.path.join(os.path.dirname(file_name),
+                         resample_tag + '_' + os.path.basename(file_name))
+            for file_name in _cache_names(datatag, input_dict, 'npy')]
+
+def gather_resampled(input_dict, data_dict=None, meta_dict=None):
+    """
+    Resample the blocked data of every datatag of `input_dict` with its
+    'resample' method, 'jackknife' (default) or 'bootstrap' with 'nboot'
+    samples (default: 1000) drawn with 'seed' (default: 0); see resample.py.
+    The bootstrap samples of all datatags with the same number of
+    configurations are drawn with one shared index matrix, so correlations
+    between datatags are preserved.
+    The samples are cached as .npy files next to the raw cache files and
+    reused as long as the database does not change. Only if some datatags
+    are not cached, the data is gathered with gather_dataset, unless its
+    output is given as `data_dict` and `meta_dict`.
+
+    Output:
+        dictionary of (nsample, nt) arrays with datatags as keys, read-only
+        memory-mapped from the cache files, and dictionary of the
+        configurations as gather_dataset returns them
+    """
+    resample_tag, nboot, seed = _resample_tag(input_dict)
+    datatag_list = _datatag_list(input_dict)
+    db_fp = db_fingerprint(input_dict['db_name'])
+    manifest = load_manifest(input_dict['data_dir'])
+    query_fp_dict = dict((datatag, query_fingerprint(datatag,
+                                                     _generate_correlator_keys_baryon(datatag, input_dict),
+                                                     input_dict, 'npy_' + resample_tag))
+                         for datatag in datatag_list)
+    sample_dict = dict()
+    sample_meta_dict = dict()
+    index_dict = dict() # bootstrap index matrix of every number of configurations
+    for datatag in datatag_list:
+        save_name, meta_save_name = _resample_names(datatag, input_dict)
+        if not _cache_fresh(input_dict, save_name, meta_save_name, db_fp,
+                            query_fp_dict[datatag], manifest=manifest):
+            if data_dict is None:
+                data_dict, meta_dict = gather_dataset(input_dict)
+            data = np.asarray(data_dict[datatag], dtype=np.float64)
+            with stage('resample', method=resample_tag, datatag=datatag, configurations=len(data)):
+                if input_dict.get('resample', 'jackknife') == 'jackknife':
+                    samples = jackknife(data)
+                else:
+                    if len(data) not in index_dict:
+                        index_dict[len(data)] = bootstrap_indices(len(data), nboot, seed)
+                    samples = bootstrap(data, index_dict[len(data)])
+            with tagged(datatag=datatag):
+                _write_cache({datatag: samples},
+                             {datatag: {'datatag': datatag,
+                                        'resample': resample_tag,
+                                        'config_index': _meta_output(meta_dict[datatag],
+                                                                     True).to_json()}},
+                             save_name, meta_save_name, 'npy_' + resample_tag)
+            _record_cache(datatag, input_dict, _generate_correlator_keys_baryon(datatag, input_dict),
+                          save_name, meta_save_name, 'npy_' + resample_tag, db_fp)
+        else:
+            touch_entry(save_name)
+        with stage('cache_read', format='npy', datatag=datatag):
+            fio_meta = open(meta_save_name, 'r')
+            meta = json.load(fio_meta)
+            fio_meta.close()
+            sample_dict[datatag] = np.load(save_name, mmap_mode='r')
+            if list(np.shape(sample_dict[datatag])) != meta['shape']:
+                raise ValueError("Mistmatch in shape of data and metadata!")
+        sample_meta_dict[datatag] = _meta_output(config_index_from_json(meta['config_index']),
+                                                 input_dict.get('config_index', False))
+    return sample_dict, sample_meta_dict
+
+def sweep_blocking(input_dict, block_sizes):
+    """
+    Block the data of every datatag of `input_dict` with all `block_sizes`
+    in one pass to choose its 'blocking', which is ignored here. The
+    correlators are read once, through the raw_cache if `input_dict` sets
+    `raw_cache_budget`, and no cache files are written.
+
+    Output:
+        dictionary of corr_db.blocking_sweep results with datatags as keys
+    """
+    datatag_list = _datatag_list(input_dict)
+    key_dict = dict((datatag, _generate_correlator_keys_baryon(datatag, input_dict))
+                    for datatag in datatag_list)
+    corr_names = []
+    for datatag in datatag_list:
+        corr_names += [name for name in key_dict[datatag] if name not in corr_names]
+    from corr_db import raw_cache, blocking_sweep
+    sweep_dict = dict()
+    with tagged(ensemble=input_dict['ensemble'], db_name=input_dict['db_name']):
+        npt_dict = raw_cache(input_dict.get('raw_cache_budget')).get(
+            input_dict['db_name'], corr_names, tuned=input_dict.get('tune_db', False),
+            workers=input_dict.get('decode_workers'),
+            pool_type=input_dict.get('decode_pool', 'thread'))
+        for datatag in datatag_list:
+            with tagged(datatag=datatag):
+                configid_list = []
+                units_list = []
+                for corr_name in key_dict[datatag]:
+                    unit_index, units, series = npt_dict[corr_name].unit_data(input_dict['avg_tsrc'])
+                    configid_list.append(unit_index)
+                    units_list.append(units)
+                if configid_list.count(configid_list[0]) != len(configid_list):
+                    raise ValueError('Error in gathering data! Possible errors in generating data!')
+                if len(units_list) > 1:
+                    # 16 = 16m + 16p as in _combine_correlators
+                    units = np.sum(np.array(units_list),axis=0)/len(units_list)
+                sweep_dict[datatag] = blocking_sweep(units, series, block_sizes)
+    return sweep_dict
+
 def dump_gpl(data_dict, meta_dict, fio, fio_meta):
     """
     Dump correlators and meta information to `fio` and `fio_meta` text files
@@ -268,6 +1320,62 @@ def load_gpl(fio, fio_meta):
         data_dict[datatag].append([float(x) for x in datl[1:]])
         meta_dict[datatag].append(metal[0])
     return data_dict, meta_dict
+
+def _save_npy(data, meta, save_name, meta_save_name):
+    """
+    Save `data` to `save_name` as a little-endian float64 .npy array and
+    the dictionary `meta`, with the shape of the array added, to the json
+    file `meta_save_name`. Existing files are replaced, not overwritten, so
+    arrays memory-mapped from them stay valid (see _replacing).
+    """
+    data = np.ascontiguousarray(data, dtype='<f8')
+    with _replacing(save_name, meta_save_name) as (tmp_name, meta_tmp_name):
+        fio = open(tmp_name, 'wb')
+        np.save(fio, data)
+        fio.close()
+        fio_meta = open(meta_tmp_name, 'w')
+        json.dump(dict(meta, shape=list(np.shape(data))), fio_meta)
+        fio_meta.close()
+
+def dump_npy(data_dict, meta_dict, save_name, meta_save_name):
+    """
+    Dump correlators to `save_name` as a little-endian float64 (nconf, nt)
+    .npy array and the meta information, a ConfigIndex or a list of
+    configId strings, as the columns of a ConfigIndex to the json file
+    `meta_save_name`.
+    """
+    if len(data_dict) != 1:
+        raise ValueError("data_dict should only have one key!")
+    for datatag in data_dict:
+        data = np.asarray(data_dict[datatag])
+        if data.ndim != 2 or len(data) != len(meta_dict[datatag]):
+            raise ValueError("Inconsistent shape between data and metadata!")
+        _save_npy(data, {'datatag': datatag,
+                         'config_index': _meta_output(meta_dict[datatag], True).to_json()},
+                  save_name, meta_save_name)
+
+def load_npy(save_name, meta_save_name, config_index=False):
+    """
+    Load the files created by `dump_npy`. Return a `data_dict` with a
+    read-only (nconf, nt) array memory-mapped from `save_name` and a
+    `meta_dict` with a list of configId strings, or a ConfigIndex if
+    `config_index` is set. Meta files with configId strings, as written by
+    older versions and by streaming, are read as well.
+    """
+    fio_meta = open(meta_save_name, 'r')
+    meta = json.load(fio_meta)
+    fio_meta.close()
+    datatag = str(meta['datatag'])
+    data = np.load(save_name, mmap_mode='r')
+    if 'config_index' in meta:
+        meta_info = config_index_from_json(meta['config_index'])
+    else:
+        meta_info = [str(i) for i in meta['configId']]
+    if list(np.shape(data)) != meta['shape'] or len(data) != len(meta_info):
+        raise ValueError("Mistmatch in shape of data and metadata!")
+    data_dict = {datatag:data}
+    meta_dict = {datatag:_meta_output(meta_info, config_index)}
+    return data_dict, meta_dict
         
 if __name__ == '__main__':
     main()
\ No newline at end of file
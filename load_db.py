@@ -0,0 +1,375 @@
+"""
+Bulk loading of correlator files into a database with the schema of DB.py.
+
+A correlator file holds one entry per line,
+
+    name series trajectory tsrc c(0) c(1) ... c(nt-1)
+
+and lines starting with '#' are ignored. The entries are written exactly as
+Datum would write them: the values are kept as the strings found in the file,
+rotated by tsrc if requested, joined with newlines and compressed with
+bz2.compress(..., 9), so the dataBZ2 entries are byte-identical to the ones
+built one Datum at a time. Instead of going through the ORM, a whole file is
+parsed into arrays, rotated with one fancy-indexing operation, compressed by
+a pool of workers and inserted with executemany in large transactions.
+
+With --incremental, files already recorded in the correlator_files table
+with the same size and modification time (or the same md5) are skipped, and
+the entries of a changed file replace the ones it stored before.
+With --codec=NAME, the values are stored as float64 with a codec of
+blob_codec instead of the legacy text encoding.
+
+usage: python load_db.py [--incremental] [--codec=NAME] db_name param_file corr_file [corr_file ...]
+"""
+import os
+import sys
+import bz2
+import datetime
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from sqlalchemy import *
+from DB import *
+from blob_codec import *
+
+def parse_correlator_file(path):
+    """
+    Parse the correlator file `path`. Return the lists of correlator names and
+    series, the arrays of trajectories and tsrc, and a (nentry, nt) array of
+    the values as strings.
+    """
+    names, series, trajectory, tsrc, values = [], [], [], [], []
+    fio = open(path, 'r')
+    for line in fio:
+        fields = line.split()
+        if len(fields) == 0 or fields[0].startswith('#'):
+            continue
+        if len(fields) < 5:
+            raise ValueError('Cannot parse line "%s" in %s!' %(line.strip(), path))
+        names.append(fields[0])
+        series.append(fields[1])
+        trajectory.append(int(fields[2]))
+        tsrc.append(int(fields[3]))
+        values.append(fields[4:])
+    fio.close()
+    if len(values) > 0 and len(set(len(ivalues) for ivalues in values)) != 1:
+        raise ValueError('Some data have inconsistent nt in %s!' %path)
+    return (names, series, np.array(trajectory, dtype=np.int64),
+            np.array(tsrc, dtype=np.int64), np.array(values, dtype=str))
+
+def rotate_rows(values, tsrc):
+    """
+    Rotate every row of `values` to the left by its tsrc, the array version
+    of rotateList in DB.py.
+    """
+    nrows, nt = np.shape(values)
+    column = (np.arange(nt)[np.newaxis,:] + np.asarray(tsrc)[:,np.newaxis]) % nt
+    return values[np.arange(nrows)[:,np.newaxis], column]
+
+def _compress_chunk(args):
+    """
+    Encode the entries in a chunk, either text the way Datum does or float
+    values with a codec in blob_codec.
+    """
+    codec, shuffle, data_list = args
+    if codec == LEGACY_CODEC:
+        return [bz2.compress(data, 9) for data in data_list]
+    return [encode_blob(data, codec=codec, shuffle=shuffle) for data in data_list]
+
+def compress_rows(values, workers=None, pool_type='thread', chunk_size=None,
+                  codec=LEGACY_CODEC, shuffle=True):
+    """
+    Encode every row of the string array `values` as a dataBZ2 entry. With
+    the legacy codec the row is joined with newlines and compressed, as in
+    Datum, otherwise its float64 values are encoded with `codec`. Return the
+    list of dataBZ2 entries.
+
+    If `workers` is larger than one, the rows are compressed in chunks of
+    `chunk_size` rows by a pool of `workers` threads (`pool_type`='thread')
+    or processes (`pool_type`='process').
+    """
+    if pool_type != 'thread' and pool_type != 'process':
+        raise ValueError("pool_type needs to be thread or process!")
+    if codec == LEGACY_CODEC:
+        data_list = ['\n'.join(row) for row in values.tolist()]
+    else:
+        data_list = list(values.astype(np.float64))
+    if workers is None or workers <= 1 or len(data_list) <= 1:
+        return _compress_chunk((codec, shuffle, data_list))
+    if chunk_size is None:
+        chunk_size = max(1, (len(data_list)-1)//(4*workers) + 1)
+    # bz2 and zlib release the GIL while compressing, so threads scale as well
+    if pool_type == 'thread':
+        pool = ThreadPool(workers)
+    else:
+        pool = multiprocessing.Pool(workers)
+    try:
+        chunk_list = pool.map(_compress_chunk, [(codec, shuffle, data_list[start:start+chunk_size])
+                                                for start in range(0, len(data_list), chunk_size)])
+    finally:
+        pool.close()
+        pool.join()
+    return [dataBZ2 for chunk in chunk_list for dataBZ2 in chunk]
+
+def _parameter_id(conn, param):
+    """
+    Return the id of the parameter set `param`, adding it if needed.
+    """
+    param_table = ParameterSet.__table__
+    param_id = conn.execute(select([param_table.c.id]).where(
+        param_table.c.param == param).order_by(param_table.c.id)).scalar()
+    if param_id is None:
+        param_id = conn.execute(param_table.insert(), param=param).inserted_primary_key[0]
+    return param_id
+
+def _correlator_ids(conn, names, param_id):
+    """
+    Return {name: id} for the correlators in `names`, adding the missing ones.
+    """
+    corr_table = Correlator.__table__
+    corr_ids = dict()
+    for corr_id, name in conn.execute(select([corr_table.c.id, corr_table.c.name]).where(
+            corr_table.c.name.in_(list(set(names)))).order_by(corr_table.c.id)):
+        corr_ids.setdefault(name, corr_id)
+    for name in names:
+        if name not in corr_ids:
+            corr_ids[name] = conn.execute(corr_table.insert(), name=name,
+                                          parameter_id=param_id).inserted_primary_key[0]
+    return corr_ids
+
+def _file_row(path, md5=None):
+    """
+    Return the correlator_files entry of `path`, as InputFile would fill it.
+    """
+    st = os.stat(path)
+    if md5 is None:
+        md5 = file_md5(path)
+    return {'path': path, 'st_size': st.st_size, 'st_mtime': st.st_mtime,
+            'addtime': datetime.datetime.utcnow(), 'md5': md5}
+
+def scan_files(db_name, file_list, workers=None):
+    """
+    Compare the files in `file_list` with the correlator_files table of
+    `db_name`. A file whose size and modification time match the last entry
+    for its path is unchanged without being read. The other known files are
+    hashed by a pool of `workers` threads and are only changed if their md5
+    differs. Return {'new': [...], 'changed': [...], 'unchanged': [...]} and
+    {path: md5} of the files that were hashed.
+    """
+    report = {'new': [], 'changed': [], 'unchanged': []}
+    stored = dict()
+    if os.path.isfile(db_name):
+        engine = create_engine('sqlite:///'+db_name)
+        file_table = InputFile.__table__
+        try:
+            if engine.dialect.has_table(engine, file_table.name):
+                for path, st_size, st_mtime, md5 in engine.execute(
+                        select([file_table.c.path, file_table.c.st_size,
+                                file_table.c.st_mtime, file_table.c.md5]
+                               ).order_by(file_table.c.id)):
+                    stored[path] = (st_size, st_mtime, md5)
+        finally:
+            engine.dispose()
+
+    candidate_list = []
+    for path in file_list:
+        if path not in stored:
+            report['new'].append(path)
+            continue
+        st = os.stat(path)
+        if (st.st_size, st.st_mtime) == stored[path][:2]:
+            report['unchanged'].append(path)
+        else:
+            candidate_list.append(path)
+
+    if workers is None or workers <= 1 or len(candidate_list) <= 1:
+        md5_list = [file_md5(path) for path in candidate_list]
+    else:
+        # hashlib releases the GIL while hashing large chunks
+        pool = ThreadPool(workers)
+        try:
+            md5_list = pool.map(file_md5, candidate_list)
+        finally:
+            pool.close()
+            pool.join()
+    md5_dict = dict(zip(candidate_list, md5_list))
+    for path in candidate_list:
+        if md5_dict[path] == stored[path][2]:
+            report['unchanged'].append(path)
+        else:
+            report['changed'].append(path)
+    return report, md5_dict
+
+def bulk_load(db_name, file_list, param, doTranslate=True, workers=None,
+              pool_type='thread', batch_size=100000, incremental=False,
+              codec=LEGACY_CODEC, shuffle=True, verbose=True):
+    """
+    Load the correlator files in `file_list` into the database `db_name`
+    with parameter set `param`. Every entry is rotated by its tsrc if
+    `doTranslate` is set. Rows are committed in transactions of at least
+    `batch_size` entries, together with the correlator_files entries of the
+    files they come from, and a new modify_times entry is added if any data
+    was added.
+    Return the number of data entries added. The entries are stored with
+    `codec` (see blob_codec); the default is the legacy encoding of Datum.
+
+    If `incremental` is set, only the new and changed files reported by
+    scan_files are loaded. An entry of a changed file whose correlator,
+    series, trajectory and tsrc are already stored with the same data is
+    skipped, and one with different data replaces the stored entries (see
+    _reloaded_rows). Entries that were removed from a changed file are kept.
+    """
+    md5_dict = dict()
+    changed = set()
+    if incremental:
+        report, md5_dict = scan_files(db_name, file_list, workers=workers)
+        if verbose:
+            for status in ['new', 'changed', 'unchanged']:
+                print '%s %s files' %(len(report[status]), status)
+        unchanged = set(report['unchanged'])
+        changed = set(report['changed'])
+        # The correlator_files entries of files that were only touched are
+        # updated, so that the next scan does not hash them again
+        touched_list = [path for path in md5_dict if path in unchanged]
+        file_list = [path for path in file_list if path not in unchanged]
+        if len(file_list) == 0 and len(touched_list) == 0:
+            return 0
+    engine = create_engine('sqlite:///'+db_name)
+    Declare.metadata.create_all(engine)
+    conn = engine.connect()
+    nrows = 0
+    try:
+        trans = conn.begin()
+        param_id = _parameter_id(conn, param)
+        data_rows, file_rows, stale_ids = [], [], []
+        if incremental:
+            _touch_files(conn, touched_list)
+        for path in file_list:
+            names, series, trajectory, tsrc, values = parse_correlator_file(path)
+            if len(names) > 0:
+                if doTranslate:
+                    values = rotate_rows(values, tsrc)
+                corr_ids = _correlator_ids(conn, names, param_id)
+                dataBZ2 = compress_rows(values, workers=workers, pool_type=pool_type,
+                                        codec=codec, shuffle=shuffle)
+                rows = [{'correlator_id': corr_ids[names[indx]],
+                         'series': series[indx],
+                         'trajectory': int(trajectory[indx]),
+                         'tsrc': int(tsrc[indx]),
+                         'parameter_id': param_id,
+                         'dataBZ2': dataBZ2[indx]} for indx in range(len(names))]
+                if path in changed:
+                    rows, file_stale_ids = _reloaded_rows(conn, rows, param_id)
+                    stale_ids.extend(file_stale_ids)
+                data_rows.extend(rows)
+            file_rows.append(_file_row(path, md5_dict.get(path)))
+            if verbose:
+                print 'Read %s entries from %s' %(len(names), path)
+                if path in changed:
+                    print 'Skipped %s entries that were stored before' %(len(names) - len(rows))
+            if len(data_rows) >= batch_size:
+                nrows += _flush(conn, data_rows, file_rows, stale_ids)
+                trans.commit()
+                trans = conn.begin()
+        nrows += _flush(conn, data_rows, file_rows, stale_ids)
+        if nrows > 0:
+            conn.execute(DBtimestamp.__table__.insert(), time=datetime.datetime.utcnow())
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
+        engine.dispose()
+    if verbose:
+        print 'Added %s entries to %s' %(nrows, db_name)
+    return nrows
+
+def _touch_files(conn, path_list):
+    """
+    Update the size and modification time of the last correlator_files
+    entry of every path in `path_list` in place. No entry is added, since
+    the fingerprint of the database (see corr_meta.db_fingerprint) counts
+    the entries and the cache files would be rebuilt without new data.
+    """
+    if len(path_list) == 0:
+        return
+    file_table = InputFile.__table__
+    latest = file_table.alias()
+    stat_list = [os.stat(path) for path in path_list]
+    conn.execute(file_table.update().where(file_table.c.id == select(
+        [func.max(latest.c.id)]).where(latest.c.path == bindparam('b_path')).as_scalar()).values(
+        st_size=bindparam('b_size'), st_mtime=bindparam('b_mtime')),
+        [{'b_path': path, 'b_size': st.st_size, 'b_mtime': st.st_mtime}
+         for path, st in zip(path_list, stat_list)])
+
+def _reloaded_rows(conn, rows, param_id):
+    """
+    Compare the data entries `rows` of a changed file with the entries
+    stored before with the same correlator, series, trajectory, tsrc and
+    parameter set `param_id`. Return the entries that are not stored yet
+    with the same data, and the ids of the stored entries they replace.
+    """
+    data_table = Datum.__table__
+    stored = dict()
+    corr_list = list(set(row['correlator_id'] for row in rows))
+    for data_id, corr_id, series, trajectory, tsrc in conn.execute(
+            select([data_table.c.id, data_table.c.correlator_id, data_table.c.series,
+                    data_table.c.trajectory, data_table.c.tsrc]).where(and_(
+                data_table.c.correlator_id.in_(corr_list),
+                data_table.c.parameter_id == param_id))):
+        stored.setdefault((corr_id, series, trajectory, tsrc), []).append(data_id)
+    def key(row):
+        return (row['correlator_id'], row['series'], row['trajectory'], row['tsrc'])
+    id_list = sorted(set(data_id for row in rows for data_id in stored.get(key(row), [])))
+    dataBZ2 = dict()
+    # Stay below the limit of sqlite on the number of bound parameters
+    for start in range(0, len(id_list), 500):
+        for data_id, idataBZ2 in conn.execute(select([data_table.c.id, data_table.c.dataBZ2]).where(
+                data_table.c.id.in_(id_list[start:start+500]))):
+            dataBZ2[data_id] = str(idataBZ2)
+    new_rows = []
+    stale_ids = set()
+    for row in rows:
+        row_ids = stored.get(key(row), [])
+        if len(row_ids) > 0 and all(dataBZ2[data_id] == row['dataBZ2'] for data_id in row_ids):
+            continue
+        new_rows.append(row)
+        stale_ids.update(row_ids)
+    return new_rows, sorted(stale_ids)
+
+def _flush(conn, data_rows, file_rows, stale_ids=[]):
+    """
+    Insert and clear the pending data and correlator_files entries, then
+    delete and clear the data entries with ids in `stale_ids` that they
+    replace. The entries are deleted after the insert so that sqlite does
+    not give a replacement the id of a deleted entry, which would hide it
+    from the incremental refresh of gather_data.
+    """
+    nrows = len(data_rows)
+    if nrows > 0:
+        conn.execute(Datum.__table__.insert(), data_rows)
+    if len(file_rows) > 0:
+        conn.execute(InputFile.__table__.insert(), file_rows)
+    data_table = Datum.__table__
+    for start in range(0, len(stale_ids), 500):
+        conn.execute(data_table.delete().where(data_table.c.id.in_(stale_ids[start:start+500])))
+    del data_rows[:]
+    del file_rows[:]
+    del stale_ids[:]
+    return nrows
+
+if __name__ == "__main__":
+    argv = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    codec = LEGACY_CODEC
+    for arg in sys.argv[1:]:
+        if arg.startswith('--codec='):
+            codec = arg[len('--codec='):]
+    if len(argv) < 3:
+        print __doc__.strip().split('\n')[-1]
+        sys.exit(1)
+    fio = open(argv[1], 'r')
+    param = fio.read()
+    fio.close()
+    bulk_load(argv[0], argv[2:], param, workers=multiprocessing.cpu_count(),
+              incremental='--incremental' in sys.argv, codec=codec)
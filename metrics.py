@@ -0,0 +1,148 @@
+"""
+Timing and counters of the stages of the gather pipeline.
+
+Every stage (correlator lookup, row fetch, decode, duplicate removal,
+blocking, 16p/16m averaging, cache read/write, ...) is wrapped in `stage`,
+which measures its wall time and collects counters such as the number of
+rows or bytes. When the stage ends, a record
+
+    {'stage': name, 'seconds': ..., 'time': ..., 'pid': ..., counters...,
+     fields of the enclosing `tagged` blocks (e.g. datatag, ensemble)}
+
+is passed to every hook registered with `add_hook`. Nothing is recorded
+while no hook is registered. `JsonLinesHook` appends the records to a file
+as JSON lines.
+"""
+import os
+import time
+import json
+import fcntl
+import threading
+import contextlib
+
+_hooks = []
+_local = threading.local()
+
+def add_hook(hook):
+    """
+    Register `hook`, a function that takes one record dictionary.
+    """
+    _hooks.append(hook)
+
+def remove_hook(hook):
+    """
+    Unregister `hook`.
+    """
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+def has_hooks():
+    """
+    Return True if any hook is registered.
+    """
+    return len(_hooks) > 0
+
+def _context():
+    if not hasattr(_local, 'context'):
+        _local.context = []
+    return _local.context
+
+@contextlib.contextmanager
+def tagged(**fields):
+    """
+    Add `fields` to all records of this thread inside the block.
+    """
+    context = _context()
+    context.append(fields)
+    try:
+        yield
+    finally:
+        context.pop()
+
+@contextlib.contextmanager
+def stage(name, **counters):
+    """
+    Time the block as stage `name`. The block gets the record dictionary,
+    initialized with `counters`, and can add counters to it. A stage that
+    ends with an exception is recorded with 'error' set.
+    """
+    record = dict(counters)
+    start_time = time.time()
+    try:
+        yield record
+    except:
+        record['error'] = True
+        raise
+    finally:
+        record['seconds'] = time.time() - start_time
+        emit(name, record)
+
+def emit(name, record):
+    """
+    Pass the record of stage `name` with the fields of the enclosing
+    `tagged` blocks to all hooks.
+    """
+    if len(_hooks) == 0:
+        return
+    full_record = {'stage': name, 'time': time.time(), 'pid': os.getpid()}
+    for fields in _context():
+        full_record.update(fields)
+    full_record.update(record)
+    for hook in list(_hooks):
+        hook(full_record)
+
+def replay(record_list):
+    """
+    Pass records collected elsewhere, e.g. by a RecordingHook in a worker
+    process, to all hooks. The fields of the enclosing `tagged` blocks are
+    added where the records do not have them.
+    """
+    for record in record_list:
+        full_record = dict()
+        for fields in _context():
+            full_record.update(fields)
+        full_record.update(record)
+        for hook in list(_hooks):
+            hook(full_record)
+
+@contextlib.contextmanager
+def recording():
+    """
+    Replace all hooks by a RecordingHook inside the block and yield it. Used
+    in worker processes, which inherit the hooks of their parent but send
+    their records back to it instead (see replay).
+    """
+    global _hooks
+    hooks = _hooks
+    recorder = RecordingHook()
+    _hooks = [recorder]
+    try:
+        yield recorder
+    finally:
+        _hooks = hooks
+
+class RecordingHook():
+    """
+    Hook that keeps all records in the list self.records.
+    """
+    def __init__(self):
+        self.records = []
+    def __call__(self, record):
+        self.records.append(record)
+
+class JsonLinesHook():
+    """
+    Hook that appends every record as one JSON line to `file_name`. Lines
+    are written under an exclusive lock, so several processes can share
+    the file.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+    def __call__(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        fio = open(self.file_name, 'a')
+        try:
+            fcntl.flock(fio, fcntl.LOCK_EX)
+            fio.write(line)
+        finally:
+            fio.close()
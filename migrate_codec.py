@@ -0,0 +1,78 @@
+"""
+Re-encode the dataBZ2 entries of a database in place with one of the codecs
+in blob_codec. Every re-encoded entry is decoded again and compared bit by
+bit with the values of the original entry before it is written, and each
+batch of entries is committed in its own transaction, so an interrupted
+migration leaves a readable database and can simply be restarted. Entries
+that already use the requested codec are skipped.
+
+usage: python migrate_codec.py db_name [codec] [--no-shuffle] [--vacuum]
+"""
+import sys
+import numpy as np
+from sqlalchemy import *
+from DB import *
+from blob_codec import *
+
+def migrate_codec(db_name, codec='zlib', shuffle=True, batch_size=10000,
+                  vacuum=False, verbose=True):
+    """
+    Re-encode all entries of the data table of `db_name` with `codec`.
+    Return the number of entries that were re-encoded. Raise ValueError,
+    leaving the current batch untouched, if an entry does not round-trip.
+    """
+    if codec == LEGACY_CODEC:
+        raise ValueError('Cannot migrate back to %s, the original text is lost!'
+                         %LEGACY_CODEC)
+    if codec not in available_codecs():
+        raise ValueError('Unknown or unavailable codec %s!' %codec)
+    engine = create_engine('sqlite:///'+db_name)
+    data_table = Datum.__table__
+    nmigrated = 0
+    last_id = -1
+    conn = engine.connect()
+    try:
+        while True:
+            rows = conn.execute(select([data_table.c.id, data_table.c.dataBZ2]).where(
+                data_table.c.id > last_id).order_by(data_table.c.id).limit(batch_size)).fetchall()
+            if len(rows) == 0:
+                break
+            last_id = rows[-1][0]
+            update_list = []
+            for datum_id, dataBZ2 in rows:
+                dataBZ2 = str(dataBZ2)
+                if blob_codec(dataBZ2) == (codec, shuffle):
+                    continue
+                data = decode_blob(dataBZ2)
+                new_dataBZ2 = encode_blob(data, codec=codec, shuffle=shuffle)
+                if not np.array_equal(decode_blob(new_dataBZ2).view(np.uint64),
+                                      data.view(np.uint64)):
+                    raise ValueError('Entry %s does not round-trip with codec %s!'
+                                     %(datum_id, codec))
+                update_list.append({'datum_id': datum_id, 'new_dataBZ2': new_dataBZ2})
+            if len(update_list) > 0:
+                trans = conn.begin()
+                conn.execute(data_table.update().where(
+                    data_table.c.id == bindparam('datum_id')).values(
+                        dataBZ2=bindparam('new_dataBZ2')), update_list)
+                trans.commit()
+                nmigrated += len(update_list)
+            if verbose:
+                print 'Re-encoded %s entries up to id %s' %(nmigrated, last_id)
+        if vacuum:
+            conn.execute('VACUUM')
+    finally:
+        conn.close()
+        engine.dispose()
+    return nmigrated
+
+if __name__ == "__main__":
+    argv = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if len(argv) < 1 or len(argv) > 2:
+        print __doc__.strip().split('\n')[-1]
+        sys.exit(1)
+    codec = 'zlib'
+    if len(argv) == 2:
+        codec = argv[1]
+    migrate_codec(argv[0], codec=codec, shuffle='--no-shuffle' not in sys.argv,
+                  vacuum='--vacuum' in sys.argv)
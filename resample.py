@@ -0,0 +1,59 @@
+"""
+Jackknife and bootstrap resampling of blocked (nconf, nt) data.
+
+The jackknife samples are built from the total sum in O(nconf) instead of
+averaging every leave-one-out subset. The bootstrap samples are drawn with
+an index matrix that only depends on the number of configurations, the
+number of samples and the seed, so data sets that are resampled with the
+same index matrix keep their correlations. Each bootstrap sample is
+computed as a weighted sum: the number of times every configuration is
+drawn, multiplied by the data.
+"""
+import numpy as np
+
+def jackknife(data):
+    """
+    Return the (nconf, nt) jackknife samples of the (nconf, nt) array
+    `data`: sample k is the mean of all configurations but k.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    nconf = len(data)
+    if nconf < 2:
+        raise ValueError('Jackknife needs at least two configurations!')
+    return (np.sum(data, axis=0) - data)/(nconf - 1)
+
+def jackknife_error(samples):
+    """
+    Return the standard error of the mean from jackknife `samples`.
+    """
+    samples = np.asarray(samples)
+    nconf = len(samples)
+    return np.sqrt(float(nconf - 1)/nconf*np.sum((samples - np.mean(samples, axis=0))**2, axis=0))
+
+def bootstrap_indices(nconf, nboot, seed):
+    """
+    Return the (nboot, nconf) matrix of the configurations drawn for every
+    bootstrap sample. It only depends on the arguments.
+    """
+    return np.random.RandomState(seed).randint(0, nconf, size=(nboot, nconf))
+
+def bootstrap(data, indices):
+    """
+    Return the (nboot, nt) bootstrap samples of the (nconf, nt) array
+    `data` for the index matrix `indices` (see bootstrap_indices): sample b
+    is the mean of the configurations indices[b].
+    """
+    data = np.asarray(data, dtype=np.float64)
+    nboot, nconf = np.shape(indices)
+    if nconf != len(data):
+        raise ValueError('The index matrix is for %s configurations, not %s!' %(nconf, len(data)))
+    # Number of times every configuration is drawn in every sample
+    flat_indices = (indices + nconf*np.arange(nboot)[:,None]).reshape(-1)
+    counts = np.bincount(flat_indices, minlength=nboot*nconf).reshape(nboot, nconf)
+    return counts.dot(data)/nconf
+
+def bootstrap_error(samples):
+    """
+    Return the standard error of the mean from bootstrap `samples`.
+    """
+    return np.std(samples, axis=0, ddof=1)
@@ -0,0 +1,158 @@
+"""
+Shared-memory export of gathered data sets for multiprocess fit workers.
+
+`publish` copies the (nconf, nt) data of every datatag into one named
+segment, a file in the shared memory file system /dev/shm (or in the
+temporary directory where there is none), and returns a SharedDataset. Its
+`descriptor` is a small picklable dictionary that is passed to the workers,
+which call `attach` to get read-only (nconf, nt) views on the segment
+without copying, so a node holds one copy of the data however many workers
+it runs:
+
+    shared = publish(data_dict, meta_dict)
+    pool = multiprocessing.Pool(8, initializer=init_worker,
+                                initargs=(shared.descriptor,))
+    ...
+    def init_worker(descriptor):
+        global data_dict, meta_dict
+        data_dict, meta_dict = attach(descriptor)
+
+The segment is removed by SharedDataset.close, or when the process that
+published it exits. Segments left behind by publishers that were killed
+are removed by the next call of `publish`. Workers that are attached keep
+their views after the segment is removed.
+"""
+import os
+import mmap
+import errno
+import atexit
+import tempfile
+import binascii
+import cPickle as pickle
+import numpy as np
+
+SEGMENT_PREFIX = 'axialdb_shm_'
+_ALIGNMENT = 64
+
+def segment_dir():
+    """
+    Return the directory of the segments: /dev/shm if it exists, otherwise
+    the temporary directory.
+    """
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+# Segments published by this process
+_owned = dict()
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+def cleanup_stale():
+    """
+    Remove the segments of this user whose publishing process is gone.
+    Return the removed paths.
+    """
+    removed = []
+    directory = segment_dir()
+    for name in os.listdir(directory):
+        if not name.startswith(SEGMENT_PREFIX):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            pid = int(name[len(SEGMENT_PREFIX):].split('_')[0])
+            if os.stat(path).st_uid != os.getuid() or _pid_alive(pid):
+                continue
+            os.remove(path)
+            removed.append(path)
+        except (ValueError, OSError):
+            continue
+    return removed
+
+def publish(data_dict, meta_dict):
+    """
+    Copy the data of every datatag of `data_dict`, as a little-endian
+    float64 (nconf, nt) array, and the pickled `meta_dict` into a new
+    segment. Return the SharedDataset that owns it.
+    """
+    cleanup_stale()
+    path = os.path.join(segment_dir(), '%s%s_%s' %(SEGMENT_PREFIX, os.getpid(),
+                                                   binascii.hexlify(os.urandom(6))))
+    descriptor = {'path': path, 'owner': os.getpid(), 'arrays': dict()}
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    _owned[path] = os.getpid()
+    fio = os.fdopen(fd, 'wb')
+    try:
+        offset = 0
+        for datatag in sorted(data_dict):
+            data = np.ascontiguousarray(data_dict[datatag], dtype='<f8')
+            if data.ndim != 2:
+                raise ValueError('The data of %s is not an (nconf, nt) array!' %datatag)
+            fio.write('\0'*(-offset % _ALIGNMENT))
+            offset += -offset % _ALIGNMENT
+            descriptor['arrays'][datatag] = (offset, list(np.shape(data)))
+            fio.write(data.tostring())
+            offset += data.nbytes
+        meta = pickle.dumps(meta_dict, pickle.HIGHEST_PROTOCOL)
+        descriptor['meta'] = (offset, len(meta))
+        fio.write(meta)
+        descriptor['size'] = offset + len(meta)
+    except:
+        fio.close()
+        _unlink(path)
+        raise
+    fio.close()
+    return SharedDataset(descriptor)
+
+def attach(descriptor):
+    """
+    Map the segment of `descriptor` and return (data_dict, meta_dict) with
+    read-only (nconf, nt) views on it.
+    """
+    fd = os.open(descriptor['path'], os.O_RDONLY)
+    try:
+        buf = mmap.mmap(fd, descriptor['size'], mmap.MAP_SHARED, mmap.PROT_READ)
+    finally:
+        os.close(fd)
+    data_dict = dict()
+    for datatag, (offset, shape) in descriptor['arrays'].iteritems():
+        data_dict[datatag] = np.frombuffer(buf, dtype='<f8', count=shape[0]*shape[1],
+                                           offset=offset).reshape(shape)
+    offset, size = descriptor['meta']
+    meta_dict = pickle.loads(buf[offset:offset+size])
+    return data_dict, meta_dict
+
+def _unlink(path):
+    if _owned.get(path) != os.getpid():
+        # Only the publisher removes a segment, not its forked children
+        return
+    del _owned[path]
+    if os.path.exists(path):
+        os.remove(path)
+
+def _unlink_all():
+    for path in list(_owned):
+        _unlink(path)
+
+atexit.register(_unlink_all)
+
+class SharedDataset():
+    """
+    Segment published by this process. `descriptor` is passed to the
+    workers (see attach), and `data_dict` and `meta_dict` are the views of
+    this process.
+    """
+    def __init__(self, descriptor):
+        self.descriptor = descriptor
+        self.data_dict, self.meta_dict = attach(descriptor)
+
+    def close(self):
+        """
+        Remove the segment. Views that are attached stay valid.
+        """
+        _unlink(self.descriptor['path'])
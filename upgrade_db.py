@@ -0,0 +1,95 @@
+"""
+Upgrade an existing database to the indexes declared in DB.py and update the
+statistics of the query planner. Databases built before the indexes were
+declared read every correlator with a full scan of the data table followed
+by a sort. The upgrade is idempotent: existing indexes are left alone and
+ANALYZE only runs if an index was added, if there are no statistics yet or
+if it is forced. The query plans of the queries issued by fetch_correlators
+and stream_blocks are reported before and after the upgrade.
+
+usage: python upgrade_db.py db_name [--analyze]
+"""
+import sys
+from sqlalchemy import *
+from sqlalchemy import inspect
+from DB import *
+from corr_db import _correlator_query, _data_query, _stream_query
+
+def _explain(conn, query):
+    """
+    Return the lines of the query plan of `query` on the connection `conn`.
+    """
+    compiled = query.compile(dialect=conn.dialect)
+    params = [compiled.params[key] for key in compiled.positiontup]
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute('EXPLAIN QUERY PLAN ' + unicode(compiled), params)
+        return [str(row[-1]) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+def query_plans(conn):
+    """
+    Return {query: plan lines} for the queries used to read correlators,
+    using the first two correlators in the database as examples.
+    """
+    corr_table = Correlator.__table__
+    name_dict = dict(conn.execute(select([corr_table.c.id, corr_table.c.name]).order_by(
+        corr_table.c.id).limit(2)).fetchall())
+    if len(name_dict) == 0:
+        name_dict = {1: 'correlator'}
+    plans = dict()
+    plans['correlator ids'] = _explain(conn, _correlator_query(name_dict.values()))
+    plans['fetch_correlators'] = _explain(conn, _data_query(name_dict))
+    plans['fetch_correlators after_id'] = _explain(
+        conn, _data_query(name_dict, after_id=dict((name, 0) for name in name_dict.values())))
+    plans['stream_blocks'] = _explain(conn, _stream_query(name_dict.keys()[0]))
+    return plans
+
+def upgrade_db(db_name, analyze=False, verbose=True):
+    """
+    Add the missing indexes declared in DB.py to `db_name` and run ANALYZE
+    if needed (or if `analyze` is set). Return a dictionary with the list
+    of created indexes and the query plans before and after.
+    """
+    engine = create_engine('sqlite:///'+db_name)
+    conn = engine.connect()
+    try:
+        for table in [Correlator.__table__, Datum.__table__]:
+            if not engine.dialect.has_table(conn, table.name):
+                raise ValueError('%s has no %s table!' %(db_name, table.name))
+        report = {'created': [], 'analyzed': False}
+        report['before'] = query_plans(conn)
+        for table in Declare.metadata.sorted_tables:
+            if not engine.dialect.has_table(conn, table.name):
+                continue
+            existing = set(index['name'] for index in inspect(conn).get_indexes(table.name))
+            for index in sorted(table.indexes, key=lambda index: index.name):
+                if index.name not in existing:
+                    if verbose:
+                        print 'Creating index %s on %s' %(index.name, table.name)
+                    index.create(conn)
+                    report['created'].append(index.name)
+        if analyze or len(report['created']) > 0 or \
+           not engine.dialect.has_table(conn, 'sqlite_stat1'):
+            if verbose:
+                print 'Running ANALYZE'
+            conn.execute('ANALYZE')
+            report['analyzed'] = True
+        report['after'] = query_plans(conn)
+    finally:
+        conn.close()
+        engine.dispose()
+    if verbose:
+        for query in sorted(report['before']):
+            print '%s:' %query
+            print '    before: %s' %'; '.join(report['before'][query])
+            print '    after:  %s' %'; '.join(report['after'][query])
+    return report
+
+if __name__ == "__main__":
+    argv = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if len(argv) != 1:
+        print __doc__.strip().split('\n')[-1]
+        sys.exit(1)
+    upgrade_db(argv[0], analyze='--analyze' in sys.argv)